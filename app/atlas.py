@@ -0,0 +1,103 @@
+import io
+from typing import List, Optional, Tuple
+
+import numpy
+
+# Texture atlas: tiles textures are packed on `size` x `size` JPEG pages, row by row (shelf packing),
+# with `padding` pixels of repeated edges around each of them against bleeding when filtering.
+# Pillow is only needed (and imported) in atlas mode.
+
+
+class Atlas:
+
+    def __init__(self, size: int = 4096, padding: int = 2, quality: int = 90):
+        self.size = size
+        self.padding = padding
+        self.quality = quality
+        self.pages = 0
+        self._page = None
+        self._x = 0
+        self._y = 0
+        self._shelfHeight = 0
+        self._completed: List[Tuple[int, bytes]] = []
+
+    # page index and remapped texture coordinates, None if the texture can't go on the atlas
+    def add(self, blob: bytes, textCoord0: numpy.ndarray) -> Optional[Tuple[int, numpy.ndarray]]:
+        try:
+            from PIL import Image, UnidentifiedImageError
+        except ImportError:
+            raise Exception("atlas mode needs Pillow (pip install Pillow)")
+
+        # coordinates out of [0, 1] would repeat the texture, so sample the neighbours on the atlas
+        if textCoord0.size > 0 and (textCoord0.min() < 0 or textCoord0.max() > 1):
+            return None
+        try:
+            image = Image.open(io.BytesIO(blob)).convert("RGB")
+        except (UnidentifiedImageError, OSError):
+            return None
+
+        width, height = image.size
+        x, y = self._place(width + 2 * self.padding, height + 2 * self.padding)
+        if x is None:
+            return None
+        x += self.padding
+        y += self.padding
+        self._paste(image, x, y)
+
+        scale = numpy.array([width, height], dtype=numpy.float64) / self.size
+        offset = numpy.array([x, y], dtype=numpy.float64) / self.size
+        return self.pages - 1, (textCoord0 * scale + offset).astype(numpy.float32)
+
+    def _place(self, width: int, height: int):
+        if width > self.size or height > self.size:
+            return None, None
+        if self._page is not None and self._x + width > self.size:
+            # next shelf
+            self._x = 0
+            self._y += self._shelfHeight
+            self._shelfHeight = 0
+        if self._page is None or self._y + height > self.size:
+            self._newPage()
+        x, y = self._x, self._y
+        self._x += width
+        self._shelfHeight = max(self._shelfHeight, height)
+        return x, y
+
+    def _newPage(self):
+        from PIL import Image
+        if self._page is not None:
+            self._completed.append((self.pages - 1, self._encode()))
+        self._page = Image.new("RGB", (self.size, self.size))
+        self.pages += 1
+        self._x = 0
+        self._y = 0
+        self._shelfHeight = 0
+
+    def _paste(self, image, x: int, y: int):
+        width, height = image.size
+        p = self.padding
+        self._page.paste(image, (x, y))
+        if p == 0:
+            return
+        # edges, then corners, stretched over the padding
+        self._page.paste(image.crop((0, 0, width, 1)).resize((width, p)), (x, y - p))
+        self._page.paste(image.crop((0, height - 1, width, height)).resize((width, p)), (x, y + height))
+        self._page.paste(image.crop((0, 0, 1, height)).resize((p, height)), (x - p, y))
+        self._page.paste(image.crop((width - 1, 0, width, height)).resize((p, height)), (x + width, y))
+        for cx, cy, px, py in [(0, 0, x - p, y - p), (width - 1, 0, x + width, y - p),
+                               (0, height - 1, x - p, y + height), (width - 1, height - 1, x + width, y + height)]:
+            self._page.paste(image.crop((cx, cy, cx + 1, cy + 1)).resize((p, p)), (px, py))
+
+    def _encode(self) -> bytes:
+        data = io.BytesIO()
+        self._page.save(data, format="JPEG", quality=self.quality)
+        return data.getvalue()
+
+    # encoded pages no more written to, all of them when final
+    def flush(self, final: bool = False) -> List[Tuple[int, bytes]]:
+        if final and self._page is not None:
+            self._completed.append((self.pages - 1, self._encode()))
+            self._page = None
+        completed = self._completed
+        self._completed = []
+        return completed
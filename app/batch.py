@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List
+
+from app.geo import getTiles
+from app.gltf import ENCODINGS, concatenateFile
+from app.server import TileService
+from app.tile import Tile
+
+# Batch of areas: the tiles shared by several areas are downloaded and decoded once.
+#
+# Each tile is counted in the areas using it. It is loaded (TileService, concurrent loads of
+# a tile being shared) by the first area merging it, then kept in memory until the last one is
+# merged. The areas are merged `threads` at a time, the work grows with the unique tiles count.
+#
+# Job file, JSON:
+#
+#   [
+#     {"bbox": [LNG0, LAT0, LNG1, LAT1], "level": 17, "output": "area.glb", "encoding": "float"},
+#     ...
+#   ]
+#
+# level (default 17) and encoding (default float) are optional, output defaults to {directory}/{index}.glb
+
+
+@dataclass
+class Area:
+    bbox: List[float]
+    level: int
+    output: str
+    encoding: str = "float"
+
+
+def readAreas(path: str, directory: str) -> List[Area]:
+    with open(path) as f:
+        entries = json.load(f)
+    areas = []
+    outputs = set()
+    for idx, entry in enumerate(entries):
+        area = Area(
+            [float(value) for value in entry['bbox']],
+            int(entry.get('level', 17)),
+            entry.get('output') or os.path.join(directory, f"{idx}.glb"),
+            entry.get('encoding', "float"))
+        if len(area.bbox) != 4 or not 12 <= area.level <= 21 or area.encoding not in ENCODINGS:
+            raise Exception(f"invalid area {idx}: {entry}")
+        # merged concurrently, they would share their temporary file and manifest
+        output = os.path.abspath(area.output)
+        if output in outputs:
+            raise Exception(f"area {idx}: {area.output} is already the output of another area")
+        outputs.add(output)
+        areas.append(area)
+    return areas
+
+
+def runBatch(service: TileService, areas: List[Area], threads: int = 4):
+    areasTiles = [getTiles(area.level - 1, *area.bbox) for area in areas]
+    references = Counter(tile for tiles in areasTiles for tile in set(tiles))
+    total = sum(len(tiles) for tiles in areasTiles)
+    print(f"{len(areas)} areas: {total} tiles, {len(references)} unique")
+    # no eviction, tiles are released when no more referenced
+    service.capacity = max(service.capacity, len(references))
+    lock = threading.Lock()
+    done = [0]
+
+    def release(tiles: List[Tile]):
+        with lock:
+            for tile in set(tiles):
+                references[tile] -= 1
+                if references[tile] == 0:
+                    service.forget(tile)
+
+    def merge(area: Area, tiles: List[Tile]):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(area.output)), exist_ok=True)
+            concatenateFile(service.jobs(tiles), area.output, 0, service, encoding=area.encoding)
+        finally:
+            release(tiles)
+        with lock:
+            done[0] += 1
+            print(f"{done[0]}/{len(areas)}: {area.output}")
+
+    with ThreadPoolExecutor(threads) as executor:
+        for future in [executor.submit(merge, area, tiles) for area, tiles in zip(areas, areasTiles)]:
+            future.result()
+
+    stats = service.stats()
+    print(f"batch: {stats['misses']} tiles loaded for {total} merged ({stats['shared']} shared while loading)")
@@ -0,0 +1,316 @@
+import hashlib
+from dataclasses import dataclass
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Optional, Tuple
+
+import crc32c
+from pygltflib import Accessor, Image, Sampler
+
+from app.gltf import BlobAccessor, BlobImage, ReadData, jsonFields
+from app.metrics import metrics
+
+# Raw tiles cache:
+#
+#   {directory}/index.sqlite         key (tile url) -> digest, size, crc32c, last access, HTTP validators
+#   {directory}/objects/ab/abcd...   content, named after its sha256
+#
+# Objects are written to a temporary file then renamed, so a crash never leaves a
+# truncated object behind, and checked against their size and crc32c when read.
+# Least recently used entries are evicted to stay below `budget` bytes (0: unlimited).
+
+
+# from the response headers: ETag, Last-Modified, and the Cache-Control max-age as an expiry date
+# (None: no expiry given, the entry is fresh until revalidated on demand)
+@dataclass
+class Validators:
+    etag: Optional[str] = None
+    lastModified: Optional[str] = None
+    expires: Optional[float] = None
+
+
+class TileCache:
+
+    def __init__(self, directory: str, budget: int = 0):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                crc INTEGER NOT NULL,
+                atime REAL NOT NULL,
+                etag TEXT,
+                lastModified TEXT,
+                expires REAL
+            )""")
+        # caches from before the validators
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(entries)")]
+        for column, type in [("etag", "TEXT"), ("lastModified", "TEXT"), ("expires", "REAL")]:
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE entries ADD COLUMN {column} {type}")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_atime ON entries (atime)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+        self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        self.evictions = 0
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.getWithValidators(key)[0]
+
+    # the content and its validators, from the same entry (None, None if not cached)
+    @metrics.timed("cache.get")
+    def getWithValidators(self, key: str) -> Tuple[Optional[bytes], Optional[Validators]]:
+        with self._lock:
+            row = self._db.execute("SELECT digest, size, crc, etag, lastModified, expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, None
+
+        digest, size, crc = row[:3]
+        try:
+            with open(self._path(digest), "rb") as f:
+                data = f.read(-1)
+        except FileNotFoundError:
+            # evicted since
+            data = None
+
+        with self._lock:
+            if data is None or len(data) != size or crc32c.crc32c(data) != crc:
+                # lost or corrupted object, forget about it
+                self._remove(key)
+                self.misses += 1
+                return None, None
+            self._db.execute("UPDATE entries SET atime = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            self.bytesRead += size
+        return data, Validators(*row[3:])
+
+    @metrics.timed("cache.put")
+    def put(self, key: str, data: bytes, validators: Validators = None):
+        validators = validators or Validators()
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        head, _ = os.path.split(path)
+        os.makedirs(head, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=head, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        with self._lock:
+            # renamed under the lock, an eviction can't remove it before it is indexed
+            os.replace(tmp, path)
+            row = self._db.execute("SELECT digest FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] == digest:
+                self._db.execute("UPDATE entries SET atime = ?, etag = ?, lastModified = ?, expires = ? WHERE key = ?",
+                                 (time.time(), validators.etag, validators.lastModified, validators.expires, key))
+                return
+            self._remove(key)
+            if not self._referenced(digest):
+                self.size += len(data)
+            self._db.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                             (key, digest, len(data), crc32c.crc32c(data), time.time(),
+                              validators.etag, validators.lastModified, validators.expires))
+            self.bytesWritten += len(data)
+            self._evict()
+
+    def validators(self, key: str) -> Optional[Validators]:
+        with self._lock:
+            row = self._db.execute("SELECT etag, lastModified, expires FROM entries WHERE key = ?", (key,)).fetchone()
+        return None if row is None else Validators(*row)
+
+    # the content is still the same (HTTP 304)
+    def revalidated(self, key: str, validators: Validators):
+        with self._lock:
+            self._db.execute("UPDATE entries SET atime = ?, etag = ?, lastModified = ?, expires = ? WHERE key = ?",
+                             (time.time(), validators.etag, validators.lastModified, validators.expires, key))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._remove(key)
+
+    def _referenced(self, digest: str) -> bool:
+        return self._db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is not None
+
+    # lock held
+    def _remove(self, key: str):
+        row = self._db.execute("SELECT digest, size FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return
+        digest, size = row
+        self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        # objects are shared by keys with the same content
+        if not self._referenced(digest):
+            self.size -= size
+            try:
+                os.unlink(self._path(digest))
+            except FileNotFoundError:
+                pass
+
+    # lock held
+    def _evict(self):
+        if self.budget <= 0:
+            return
+        while self.size > self.budget:
+            row = self._db.execute("SELECT key FROM entries ORDER BY atime LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._remove(row[0])
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytesRead': self.bytesRead,
+            'bytesWritten': self.bytesWritten,
+            'evictions': self.evictions,
+            'entries': entries,
+            'size': self.size,
+        }
+
+
+# Decoded tiles cache:
+#
+#   {directory}/{tile name}.tile
+#
+#   'TILE' | version | JSON length | JSON | blobs, 8 bytes aligned
+#
+# The JSON holds the accessors, image and sampler, and where their blobs are. The file is
+# read whole, the blobs being views over it: no file stays open (nor mapped) for the tiles
+# kept in memory, e.g. by the TileService.
+# An entry is only used if the glTF it was decoded from still has the same size and crc32c.
+
+DECODED_MAGIC = b'TILE'
+DECODED_VERSION = 2
+
+
+class DecodedTileCache:
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # read by concurrent merges (serve, batch)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.tile")
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @metrics.timed("decodedCache.get")
+    def get(self, key: str, source: bytes) -> Optional[ReadData]:
+        try:
+            with open(self._path(key), "rb") as f:
+                view = memoryview(f.read())
+        except OSError:
+            # missing, or unreadable (e.g. out of file descriptors): decoded again
+            self._count("misses")
+            return None
+
+        try:
+            if not (view[0:4] == DECODED_MAGIC and int.from_bytes(view[4:8], "little") == DECODED_VERSION):
+                raise ValueError("not a decoded tile of this version")
+            jsonLength = int.from_bytes(view[8:12], "little")
+            header = json.loads(bytes(view[12:12 + jsonLength]))
+            if header['source'] != [len(source), crc32c.crc32c(source)]:
+                raise ValueError("decoded from another tile")
+
+            start = 12 + jsonLength + (-(12 + jsonLength) % 8)
+
+            def blob(entry):
+                offset = start + entry['offset']
+                if offset + entry['length'] > len(view):
+                    raise ValueError("truncated")
+                return view[offset:offset + entry['length']]
+
+            def blobAccessor(entry):
+                return BlobAccessor(blob(entry), Accessor(**entry['accessor']))
+
+            data = ReadData(
+                blobAccessor(header['points']),
+                blobAccessor(header['textCoord0']),
+                blobAccessor(header['indices']),
+                BlobImage(blob(header['texture']), Image(**header['texture']['image'])),
+                Sampler(**header['sampler']))
+        except (ValueError, KeyError, TypeError):
+            # stale, short or garbled entry: decoded again, then overwritten
+            self._count("misses")
+            return None
+        self._count("hits")
+        return data
+
+    @metrics.timed("decodedCache.put")
+    def put(self, key: str, source: bytes, data: ReadData):
+        blobs = []
+        offset = 0
+
+        def entry(blob) -> dict:
+            nonlocal offset
+            padding = -offset % 8
+            blobs.append(bytes(padding))
+            blobs.append(blob)
+            offset += padding
+            result = {'offset': offset, 'length': len(blob)}
+            offset += len(blob)
+            return result
+
+        header = {
+            'source': [len(source), crc32c.crc32c(source)],
+            'points': {**entry(data.points.blob), 'accessor': jsonFields(data.points.accessor)},
+            'textCoord0': {**entry(data.textCoord0.blob), 'accessor': jsonFields(data.textCoord0.accessor)},
+            'indices': {**entry(data.indices.blob), 'accessor': jsonFields(data.indices.accessor)},
+            'texture': {**entry(data.texture.blob), 'image': jsonFields(data.texture.image)},
+            'sampler': jsonFields(data.sampler),
+        }
+        jsonBlob = json.dumps(header, separators=(',', ':')).encode("utf-8")
+        jsonBlob += b' ' * (-(12 + len(jsonBlob)) % 8)
+
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(DECODED_MAGIC)
+                f.write(DECODED_VERSION.to_bytes(4, "little"))
+                f.write(len(jsonBlob).to_bytes(4, "little"))
+                f.write(jsonBlob)
+                for blob in blobs:
+                    f.write(blob)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -3,9 +3,12 @@ import json
 import os
 
 from dotenv import load_dotenv
+from app.metrics import metrics
+from app.tile import Tile
 load_dotenv()
 
 # https://github.com/CesiumGS/3d-tiles/blob/main/specification/TileFormats/Batched3DModel/README.md
+@metrics.timed("read3dm")
 def read3dm(data: bytes):
     i = 0
     magic = data[i:i + 4]
@@ -47,7 +50,10 @@ def read3dm(data: bytes):
 
 
 # ex: tileName 21112330 return {ROOT}/Data/211/123/L17_21112330.b3dm
+# (tiles names are only spelled out here)
 def getUrl(tileName):
+    if isinstance(tileName, Tile):
+        tileName = tileName.name
     level = len(tileName)
     path = "/"
     idx = 0
@@ -66,3 +72,4 @@ def getUrl(tileName):
 if __name__ == "__main__":
 
     assert(getUrl("21112330") == "/Data/211/123/L17_21112330.b3dm")
+    assert(getUrl(Tile.fromName("21112330")) == "/Data/211/123/L17_21112330.b3dm")
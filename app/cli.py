@@ -1,60 +1,66 @@
-
-import sys
-import time
+import argparse
 import os
-import requests
+import time
 from dotenv import load_dotenv
-from pathlib import Path
 
-from app.geo import getTilesNames, testGeoSearch
+from app.geo import getTiles, iterTilesNames
 from app.cesium import read3dm, getUrl
-from app.gltf import concatenate, Job, Jobs, _debugReadgltf
+from app.metrics import metrics
+from app.tile import Tile
+
+# app.gltf, app.download and app.cache (pygltflib, numpy, requests) are imported by the commands using them:
+# `app-cli --help` or a worker process don't pay for what they don't use
 
 load_dotenv()
 
 BASE_DIR = os.getenv("BASE_DIR")
 ROOT = os.getenv("ROOT")
+# concurrent downloads, and requests per second per host (0: unlimited)
+PARALLELISM = int(os.getenv("PARALLELISM", 8))
+RATE_LIMIT = float(os.getenv("RATE_LIMIT", 0))
+# raw tiles cache size limit in bytes (0: unlimited)
+CACHE_BUDGET = int(os.getenv("CACHE_BUDGET", 0))
+# processes decoding the tiles (0: decode in the main process)
+WORKERS = int(os.getenv("WORKERS", 0))
 
-def fetch(url, retry=5):
-    fileCache = BASE_DIR + url.replace("/", os.sep) + '.glb'
-    
-    if Path(fileCache).is_file():
-        f = open(fileCache, "rb")
-        return f.read(-1)
 
-    head, _ = os.path.split(fileCache)
-    Path(head).mkdir(parents=True, exist_ok=True)
-    try:
-        r = requests.get(ROOT + url)
-        if r.status_code == 404:
-            raise ConnectionError()
-        f = open(fileCache, "wb")
-        f.write(r.content)
-        return r.content
-    except ConnectionError as e:
-        print(f"failed! retry({retry}) ${url}")
-        retry = retry - 1
-        if retry <= 0:
-            print(e)
-            sys.exit(1)
-        else:
-            time.sleep(5)
-            return fetch(url, retry)
-
-def convert(position, definition=17):
+def _downloader(parallelism):
+    from app.download import Downloader
+    from app.cache import TileCache
+
+    cache = TileCache(os.path.join(BASE_DIR, "cache"), CACHE_BUDGET)
+    downloader = Downloader(ROOT, cache, parallelism, RATE_LIMIT)
+    metrics.source("download", downloader.stats)
+    metrics.source("cache", cache.stats)
+    return downloader
+
+
+def _printCacheStats(cache):
+    stats = cache.stats()
+    print(f"cache: {stats['hits']} hits, {stats['misses']} misses, {stats['bytesRead']} bytes read, "
+          f"{stats['bytesWritten']} bytes written, {stats['evictions']} evictions, {stats['size']} bytes cached")
+
+
+def convert(position, definition=17, parallelism=PARALLELISM, workers=WORKERS, output=None, atlas=0, merge=False, encoding="float", incremental=False):
+    from app.gltf import concatenateFile, Job, Jobs
+    from app.cache import DecodedTileCache
+
     [lng0, lat0, lng1, lat1] = position
-    tiles = getTilesNames(definition-1, lng0, lat0, lng1, lat1)
-    progress = [1, len(tiles)]
+    tiles = getTiles(definition-1, lng0, lat0, lng1, lat1)
+    index = {tile: idx for idx, tile in enumerate(tiles)}
 
-    def provider(tile: str) -> Job:
-        print(f"{progress[0]}/{progress[1]}: {tile}")
-        progress[0] += 1
+    downloader = _downloader(parallelism)
+    decoded = DecodedTileCache(os.path.join(BASE_DIR, "decoded"))
+    metrics.source("decoded", decoded.stats)
+
+    # run on `parallelism` threads ahead of the merge
+    def provider(tile: Tile) -> Job:
+        print(f"{index[tile] + 1}/{len(tiles)}: {tile}")
+        data = downloader.fetch(getUrl(tile))
         try:
-            url = getUrl(tile)
-            data = fetch(url, 0)
             gltf, feature = read3dm(data)
             return Job(
-                tile,
+                tile.name,
                 gltf,
                 feature['RTC_CENTER']
             )
@@ -62,10 +68,192 @@ def convert(position, definition=17):
             print(f"failed!")
             return None
 
-    glb = concatenate(Jobs(tiles, provider))
-    f = open(os.path.join(BASE_DIR, f"merge.glb"), "wb")
-    for data in glb:
-        f.write(data)
+    if output is None:
+        output = os.path.join(BASE_DIR, f"merge.glb")
+    concatenateFile(Jobs(tiles, provider, downloader.parallelism), output, workers, decoded, atlas, merge, encoding, incremental)
+
+    _printCacheStats(downloader.cache)
+    stats = decoded.stats()
+    print(f"decoded: {stats['hits']} hits, {stats['misses']} misses")
+
+
+# revalidate the cached tiles of an area (conditional requests), and download the missing ones
+def refresh(position, definition=17, parallelism=PARALLELISM):
+    [lng0, lat0, lng1, lat1] = position
+    tiles = getTiles(definition-1, lng0, lat0, lng1, lat1)
+    downloader = _downloader(parallelism)
+    for idx, _ in enumerate(downloader.map((getUrl(tile) for tile in tiles), revalidate=True)):
+        print(f"{idx + 1}/{len(tiles)}: {tiles[idx]}")
+    print(f"refresh: {downloader.notModified} not modified, {downloader.downloaded} downloaded, {downloader.notFound} not found")
+    _printCacheStats(downloader.cache)
+
+
+# fill the cache with the tiles of an area, from minLevel to maxLevel, so converting it is then local
+def prefetch(position, minLevel=17, maxLevel=17, parallelism=PARALLELISM):
+    [lng0, lat0, lng1, lat1] = position
+    downloader = _downloader(parallelism)
+
+    def report(count, elapsed):
+        elapsed = max(elapsed, 1e-6)
+        print(f"{count} tiles in {elapsed:.1f} s: {count / elapsed:.1f} tiles/s, {downloader.bytes / elapsed / 1e6:.2f} MB/s, "
+              f"{downloader.downloaded} downloaded, {downloader.cached} cached, {downloader.retried} retries, "
+              f"{downloader.notFound} not found, {downloader.failures} failed")
+
+    # names are generated lazily, a large area at a fine level doesn't need them all at once
+    urls = (getUrl(name) for level in range(minLevel, maxLevel + 1) for name in iterTilesNames(level-1, lng0, lat0, lng1, lat1))
+    start = time.monotonic()
+    count = 0
+    for count, _ in enumerate(downloader.prefetch(urls), 1):
+        if count % 100 == 0:
+            report(count, time.monotonic() - start)
+    report(count, time.monotonic() - start)
+    _printCacheStats(downloader.cache)
+
+
+# tileset of the area tiles and their ancestors down to `minLevel` (both getUrl levels, L12 to L21)
+def tileset(position, definition=17, minLevel=12, parallelism=PARALLELISM, output=None):
+    from app.tileset import writeTileset
+
+    [lng0, lat0, lng1, lat1] = position
+    tiles = getTiles(definition-1, lng0, lat0, lng1, lat1)
+    downloader = _downloader(parallelism)
+    if output is None:
+        output = os.path.join(BASE_DIR, "tileset")
+    writeTileset(downloader, tiles, minLevel - 9, output)
+    _printCacheStats(downloader.cache)
+
+
+# merge areas on demand over HTTP, the tiles being kept in memory between the requests
+def serve(host="127.0.0.1", port=8000, capacity=2048, requests=4, parallelism=PARALLELISM):
+    from app.server import TileService, serve
+    from app.cache import DecodedTileCache
+
+    decoded = DecodedTileCache(os.path.join(BASE_DIR, "decoded"))
+    metrics.source("decoded", decoded.stats)
+    service = TileService(_downloader(parallelism), decoded, capacity, requests, parallelism)
+    metrics.source("tiles", service.stats)
+    serve(service, host, port)
+
+
+# merge the areas of a job file, the tiles shared by several areas being downloaded and decoded once
+def batch(path, threads=4, parallelism=PARALLELISM, output=None):
+    from app.batch import readAreas, runBatch
+    from app.server import TileService
+    from app.cache import DecodedTileCache
+
+    if output is None:
+        output = os.path.join(BASE_DIR, "batch")
+    areas = readAreas(path, output)
+    decoded = DecodedTileCache(os.path.join(BASE_DIR, "decoded"))
+    metrics.source("decoded", decoded.stats)
+    downloader = _downloader(parallelism)
+    service = TileService(downloader, decoded, 0, threads, parallelism)
+    metrics.source("tiles", service.stats)
+    runBatch(service, areas, threads)
+    _printCacheStats(downloader.cache)
+
+
+# metrics export and profiling of a command
+def _instrumented(args, command):
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+    try:
+        command()
+    finally:
+        if profiler is not None:
+            # the main thread only (the merge), not the download threads
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"profile: {args.profile} (python -m pstats {args.profile})")
+        if args.tracemalloc:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            metrics.count("tracedPeakBytes", peak)
+            print(f"tracemalloc: {current} bytes allocated, {peak} bytes at peak, top {args.tracemalloc}:")
+            for stat in snapshot.statistics("lineno")[:args.tracemalloc]:
+                print(f"  {stat}")
+        if args.metrics:
+            metrics.writeJson(args.metrics)
+        if args.prometheus:
+            metrics.writePrometheus(args.prometheus)
+
+
+def main(argv=None):
+    instrumentation = argparse.ArgumentParser(add_help=False)
+    instrumentation.add_argument("--metrics", metavar="FILE", help="write the stages timers and counters as JSON (- for stdout)")
+    instrumentation.add_argument("--prometheus", metavar="FILE", help="write them as a Prometheus textfile (.prom)")
+    instrumentation.add_argument("--profile", metavar="FILE", help="cProfile the command into FILE")
+    instrumentation.add_argument("--tracemalloc", type=int, default=0, metavar="N", help="trace the allocations, print the N top sites")
+
+    parser = argparse.ArgumentParser(prog="app-cli")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("convert", parents=[instrumentation], help="merge the tiles of an area into a single GLB")
+    command.add_argument("bbox", nargs=4, type=float, metavar="COORD", help="LNG0 LAT0 LNG1 LAT1, top left and bottom right corners")
+    command.add_argument("--level", type=int, default=17, help="tiles level, 12 to 21 (default: 17)")
+    command.add_argument("--output", help="GLB file (default: {BASE_DIR}/merge.glb)")
+    command.add_argument("--parallelism", type=int, default=PARALLELISM, help="concurrent downloads")
+    command.add_argument("--workers", type=int, default=WORKERS, help="decoding processes")
+    command.add_argument("--atlas", type=int, default=0, metavar="SIZE", help="pack the textures on SIZE x SIZE atlas pages, e.g. 4096 (needs Pillow)")
+    command.add_argument("--merge", action="store_true", help="merge the tiles sharing a material (an atlas page) into one primitive")
+    command.add_argument("--encoding", choices=["float", "quantized", "meshopt"], default="float",
+                         help="vertices as read, quantized (KHR_mesh_quantization), or quantized and compressed (EXT_meshopt_compression)")
+    command.add_argument("--incremental", action="store_true", help="only decode the tiles changed since the previous merge in OUTPUT (not with --atlas nor --merge)")
+
+    command = commands.add_parser("refresh", parents=[instrumentation], help="revalidate the cached tiles of an area, only changed ones are downloaded")
+    command.add_argument("bbox", nargs=4, type=float, metavar="COORD", help="LNG0 LAT0 LNG1 LAT1, top left and bottom right corners")
+    command.add_argument("--level", type=int, default=17, help="tiles level, 12 to 21 (default: 17)")
+    command.add_argument("--parallelism", type=int, default=PARALLELISM, help="concurrent downloads")
+
+    command = commands.add_parser("prefetch", parents=[instrumentation], help="download the tiles of an area into the cache, ahead of a convert")
+    command.add_argument("bbox", nargs=4, type=float, metavar="COORD", help="LNG0 LAT0 LNG1 LAT1, top left and bottom right corners")
+    command.add_argument("--level", type=int, default=17, help="finest tiles level, 12 to 21 (default: 17)")
+    command.add_argument("--min-level", type=int, help="coarsest tiles level, 12 to 21 (default: --level)")
+    command.add_argument("--parallelism", type=int, default=PARALLELISM, help="concurrent downloads")
+
+    command = commands.add_parser("batch", parents=[instrumentation], help="merge the areas of a job file, shared tiles being downloaded and decoded once")
+    command.add_argument("jobs", help='JSON job file: [{"bbox": [LNG0, LAT0, LNG1, LAT1], "level": 17, "output": "area.glb", "encoding": "float"}, ...]')
+    command.add_argument("--threads", type=int, default=4, help="areas merged concurrently (default: 4)")
+    command.add_argument("--output", help="directory of the GLB without output in the job file (default: {BASE_DIR}/batch)")
+    command.add_argument("--parallelism", type=int, default=PARALLELISM, help="concurrent downloads")
+
+    command = commands.add_parser("tileset", parents=[instrumentation], help="write a 3D Tiles tileset of an area, with its lower levels")
+    command.add_argument("bbox", nargs=4, type=float, metavar="COORD", help="LNG0 LAT0 LNG1 LAT1, top left and bottom right corners")
+    command.add_argument("--level", type=int, default=17, help="finest tiles level, 12 to 21 (default: 17)")
+    command.add_argument("--min-level", type=int, default=12, help="coarsest tiles level, 12 to 21 (default: 12)")
+    command.add_argument("--output", help="tileset directory (default: {BASE_DIR}/tileset)")
+    command.add_argument("--parallelism", type=int, default=PARALLELISM, help="concurrent downloads")
+
+    command = commands.add_parser("serve", parents=[instrumentation], help="merge areas on demand over HTTP: GET /convert?bbox=LNG0,LAT0,LNG1,LAT1&level=17")
+    command.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    command.add_argument("--port", type=int, default=8000, help="port to listen on (default: 8000)")
+    command.add_argument("--capacity", type=int, default=2048, help="decoded tiles kept in memory (default: 2048)")
+    command.add_argument("--requests", type=int, default=4, help="concurrent merges (default: 4)")
+    command.add_argument("--parallelism", type=int, default=PARALLELISM, help="concurrent downloads")
+
+    args = parser.parse_args(argv)
+    if args.command == "convert":
+        _instrumented(args, lambda: convert(args.bbox, args.level, args.parallelism, args.workers, args.output, args.atlas, args.merge, args.encoding, args.incremental))
+    elif args.command == "refresh":
+        _instrumented(args, lambda: refresh(args.bbox, args.level, args.parallelism))
+    elif args.command == "prefetch":
+        _instrumented(args, lambda: prefetch(args.bbox, args.level if args.min_level is None else args.min_level, args.level, args.parallelism))
+    elif args.command == "batch":
+        _instrumented(args, lambda: batch(args.jobs, args.threads, args.parallelism, args.output))
+    elif args.command == "serve":
+        _instrumented(args, lambda: serve(args.host, args.port, args.capacity, args.requests, args.parallelism))
+    elif args.command == "tileset":
+        _instrumented(args, lambda: tileset(args.bbox, args.level, args.min_level, args.parallelism, args.output))
 
 
-convert([3.05828278697053, 50.63790367370581, 3.0651009622863867, 50.63476396066108])
\ No newline at end of file
+# guarded: worker processes re-import the main module on spawn platforms (Windows)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Deque, Dict, Iterable, Iterator, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.cache import TileCache, Validators
+from app.metrics import metrics
+
+# statuses worth another try, anything else (but 404) is a hard failure
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+# validators of a response, the previous ones being kept when it has none (a 304 may not repeat them)
+def responseValidators(response: requests.Response, previous: Validators = None) -> Validators:
+    previous = previous or Validators()
+    expires = None
+    for directive in response.headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name.lower() == "max-age" and value.isdigit():
+            expires = time.time() + int(value)
+        elif name.lower() in ["no-cache", "no-store"]:
+            expires = time.time()
+    return Validators(
+        response.headers.get("ETag", previous.etag),
+        response.headers.get("Last-Modified", previous.lastModified),
+        expires)
+
+
+class RateLimiter:
+
+    # requests per second, 0 means unlimited
+    def __init__(self, rate: float = 0):
+        self._interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self._interval == 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Downloader:
+
+    def __init__(self, root: str, cache: TileCache, parallelism: int = 8, rate: float = 0,
+                 retries: int = 5, backoff: float = 0.5, maxBackoff: float = 30, timeout: float = 30):
+        self.root = root
+        self.cache = cache
+        self.parallelism = max(1, parallelism)
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.timeout = timeout
+
+        # one pooled session shared by all the workers
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.parallelism, pool_maxsize=self.parallelism)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._limiters: Dict[str, RateLimiter] = {}
+        self._lock = threading.Lock()
+
+        self.downloaded = 0
+        self.notModified = 0
+        self.notFound = 0
+        self.cached = 0
+        self.retried = 0
+        self.failures = 0
+        # downloaded bytes
+        self.bytes = 0
+
+    def _limiter(self, url: str) -> RateLimiter:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = RateLimiter(self.rate)
+            return self._limiters[host]
+
+    # exponential backoff with full jitter
+    def _delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** attempt))
+
+    def _count(self, counter: str, n: int = 1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    # the response (200, 304 or 404), None if the download failed
+    @metrics.timed("download")
+    def _download(self, url: str, validators: Validators = None) -> Optional[requests.Response]:
+        # conditional request: unchanged content costs a 304 without body
+        headers = {}
+        if validators is not None and validators.etag is not None:
+            headers["If-None-Match"] = validators.etag
+        if validators is not None and validators.lastModified is not None:
+            headers["If-Modified-Since"] = validators.lastModified
+
+        attempt = 0
+        while True:
+            self._limiter(url).wait()
+            try:
+                r = self._session.get(url, headers=headers, timeout=self.timeout)
+                if r.status_code == 404:
+                    return r
+                if r.status_code not in RETRY_STATUS:
+                    r.raise_for_status()
+                    return r
+                error = f"HTTP {r.status_code}"
+            except requests.HTTPError as e:
+                print(f"failed! {e}")
+                self._count("failures")
+                return None
+            except requests.RequestException as e:
+                error = str(e)
+
+            if attempt >= self.retries:
+                print(f"failed! {error}")
+                self._count("failures")
+                return None
+            print(f"failed! retry({self.retries - attempt}) {url}")
+            self._count("retried")
+            time.sleep(self._delay(attempt))
+            attempt += 1
+
+    # cached tiles are used as long as they are fresh (their max-age), or revalidated first if asked to
+    def fetch(self, url: str, revalidate: bool = False) -> Optional[bytes]:
+        data, validators = self.cache.getWithValidators(url)
+        if data is not None and not revalidate and (validators.expires is None or validators.expires > time.time()):
+            return data
+
+        response = self._download(self.root + url, validators)
+        if response is None:
+            # better stale than nothing
+            return data
+        if response.status_code == 404:
+            self._count("notFound")
+            if data is not None:
+                self.cache.delete(url)
+            return None
+        if response.status_code == 304 and data is not None:
+            self._count("notModified")
+            self.cache.revalidated(url, responseValidators(response, validators))
+            return data
+
+        self._count("downloaded")
+        self._count("bytes", len(response.content))
+        self.cache.put(url, response.content, responseValidators(response))
+        return response.content
+
+    def stats(self):
+        return {
+            'downloaded': self.downloaded,
+            'bytes': self.bytes,
+            'notModified': self.notModified,
+            'notFound': self.notFound,
+            'cached': self.cached,
+            'retries': self.retried,
+            'failures': self.failures,
+        }
+
+    # make sure a tile is cached, a fresh cached tile is not even read
+    def warm(self, url: str) -> bool:
+        validators = self.cache.validators(url)
+        if validators is not None and (validators.expires is None or validators.expires > time.time()):
+            self._count("cached")
+            return True
+        return self.fetch(url) is not None
+
+    # at most `parallelism` calls in flight, results are yielded in urls order
+    def _ahead(self, function, urls: Iterable[str], *args) -> Iterator:
+        with ThreadPoolExecutor(self.parallelism) as executor:
+            pending: Deque = deque()
+            for url in urls:
+                pending.append(executor.submit(function, url, *args))
+                if len(pending) >= self.parallelism:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    # fetch ahead
+    def map(self, urls: Iterable[str], revalidate: bool = False) -> Iterator[Optional[bytes]]:
+        return self._ahead(self.fetch, urls, revalidate)
+
+    # warm the cache ahead, whether each tile is cached
+    def prefetch(self, urls: Iterable[str]) -> Iterator[bool]:
+        return self._ahead(self.warm, urls)
+
+
+if __name__ == "__main__":
+    import tempfile
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    # stub server: path -> body, ETag, Cache-Control
+    files = {
+        "/a": [b"A" * 1000, '"a1"', None],
+        "/b": [b"B" * 1000, '"b1"', "max-age=3600"],
+    }
+    requested = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requested.append((self.path, self.headers.get("If-None-Match")))
+            if self.path not in files:
+                self.send_response(404)
+                self.end_headers()
+                return
+            body, etag, cacheControl = files[self.path]
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+            if cacheControl is not None:
+                self.send_header("Cache-Control", cacheControl)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = TileCache(directory)
+        downloader = Downloader(f"http://127.0.0.1:{server.server_address[1]}", cache, 2, retries=0)
+
+        # first fetch: downloaded with its validators, then served by the cache
+        assert(list(downloader.map(["/a", "/b", "/c"])) == [files["/a"][0], files["/b"][0], None])
+        assert(cache.validators("/a").etag == '"a1"' and cache.validators("/a").expires is None)
+        assert(cache.validators("/b").expires > time.time())
+        assert(downloader.fetch("/a") == files["/a"][0] and len(requested) == 3)
+        assert(downloader.bytes == 2000 and downloader.notFound == 1)
+
+        # warm up: cached tiles are neither requested nor read
+        hits = cache.hits
+        assert(list(downloader.prefetch(["/a", "/b", "/c"])) == [True, True, False])
+        assert(downloader.cached == 2 and cache.hits == hits and len(requested) == 4)
+
+        # revalidation: 304 without body while unchanged, new content otherwise
+        requested.clear()
+        files["/b"][0:2] = [b"C" * 1000, '"b2"']
+        assert(list(downloader.map(["/a", "/b"], revalidate=True)) == [files["/a"][0], b"C" * 1000])
+        assert(sorted(requested) == [("/a", '"a1"'), ("/b", '"b1"')])
+        assert(downloader.notModified == 1 and downloader.downloaded == 3 and cache.validators("/b").etag == '"b2"')
+
+        # expired entries are revalidated on their own
+        cache.revalidated("/a", Validators('"a1"', None, time.time() - 1))
+        requested.clear()
+        assert(downloader.fetch("/a") == files["/a"][0] and requested == [("/a", '"a1"')])
+
+        # tiles gone upstream leave the cache
+        del files["/a"]
+        assert(downloader.fetch("/a", revalidate=True) is None and cache.get("/a") is None)
+
+    server.shutdown()
@@ -1,18 +1,50 @@
-from typing import MutableSequence
-from pyproj import CRS, Transformer
-from app.tile import TileSystem, BasicTileSystem
+from functools import lru_cache
+from typing import Iterator, List, MutableSequence
+from app.tile import TileSystem, BasicTileSystem, Tile, morton
 
-crs_llh = CRS("EPSG:4979")
-crs_xyz = CRS("EPSG:4978")
-xyz2llh = Transformer.from_crs(crs_from=crs_xyz, crs_to=crs_llh).transform
-llh2xyz = Transformer.from_crs(crs_from=crs_llh, crs_to=crs_xyz, always_xy=True).transform
+crs_llh = "EPSG:4979"
+crs_xyz = "EPSG:4978"
 
+crs_ll = "EPSG:4326"
+# crs_xy = "EPSG:3857"  # Web Mercator
+crs_xy = "EPSG:2154"  # Lambert 93
 
-crs_ll = CRS("EPSG:4326")
-# crs_xy = CRS("EPSG:3857")  # Web Mercator
-crs_xy = CRS("EPSG:2154")  # Lambert 93
-xy2ll = Transformer.from_crs(crs_from=crs_xy, crs_to=crs_ll).transform
-ll2xy = Transformer.from_crs(crs_from=crs_ll, crs_to=crs_xy, always_xy=True).transform
+
+# transformers are built on first use, then reused (pyproj is only imported then)
+@lru_cache(maxsize=None)
+def _transformer(crsFrom: str, crsTo: str, alwaysXy: bool = False):
+    from pyproj import CRS, Transformer
+    return Transformer.from_crs(crs_from=CRS(crsFrom), crs_to=CRS(crsTo), always_xy=alwaysXy)
+
+
+# all of them take scalars as well as numpy arrays, arrays are transformed in one call
+def xyz2llh(*args):
+    return _transformer(crs_xyz, crs_llh).transform(*args)
+
+
+def llh2xyz(*args):
+    return _transformer(crs_llh, crs_xyz, True).transform(*args)
+
+
+def xy2ll(*args):
+    return _transformer(crs_xy, crs_ll).transform(*args)
+
+
+def ll2xy(*args):
+    return _transformer(crs_ll, crs_xy, True).transform(*args)
+
+
+# East, North and Up unit vectors (rows) in ECEF at lat/lng (degrees), (..., 3, 3) for arrays
+def enuRotation(lat, lng):
+    import numpy
+    lat = numpy.radians(lat)
+    lng = numpy.radians(lng)
+    zero = numpy.zeros_like(lat)
+    return numpy.stack([
+        numpy.stack([-numpy.sin(lng), numpy.cos(lng), zero], axis=-1),
+        numpy.stack([-numpy.sin(lat) * numpy.cos(lng), -numpy.sin(lat) * numpy.sin(lng), numpy.cos(lat)], axis=-1),
+        numpy.stack([numpy.cos(lat) * numpy.cos(lng), numpy.cos(lat) * numpy.sin(lng), numpy.sin(lat)], axis=-1),
+    ], axis=-2)
 
 
 def xy2ll_rectangle(bbox):
@@ -22,6 +54,14 @@ def xy2ll_rectangle(bbox):
     return [lat0, lng0, lat1, lng1]
 
 
+# batch xy2ll_rectangle, bboxes is a (n, 4) array
+def xy2ll_rectangles(bboxes):
+    import numpy
+    bboxes = numpy.asarray(bboxes, dtype=numpy.float64).reshape(-1, 4)
+    lats, lngs = xy2ll(bboxes[:, 0::2], bboxes[:, 1::2])
+    return numpy.stack([lats[:, 0], lngs[:, 0], lats[:, 1], lngs[:, 1]], axis=-1)
+
+
 def dec2dms(dd: float):
     mult = -1 if dd < 0 else 1
     mnt, sec = divmod(abs(dd) * 3600, 60)
@@ -39,13 +79,15 @@ def strll(ll: MutableSequence[float]):
 # catersian: [4046850.44102724, 214219.260762576, 4908790.13901585]
 # lat/long:  (50.646993960909164, 3.0301131155001353, 68.36377274151891)
 # dms:       50°38'49.178, 3°1'48.407
-AX, AY = ll2xy(3.0301131155001353, 50.646993960909164)
+# xy:        ll2xy(3.0301131155001353, 50.646993960909164), precomputed
+AX, AY = 702133.5154506749, 7061118.311360067
 # BOTTOM RIGHT
 # tile: L20_21222222222
 # catersian: [4052795.71053559, 223199.559304975, 4903539.99016507]
 # lat/long:  (50.57243526433171, 3.1522652309582746, 85.52446734998375)
 # dms:       #50°34'20.767, 3°9'8.155
-BX, BY = ll2xy(3.1522652309582746, 50.57243526433171)
+# xy:        ll2xy(3.1522652309582746, 50.57243526433171), precomputed
+BX, BY = 710804.0113902171, 7052820.56095144
 
 # L9 bounding box
 WIDTH = abs(AX - BX) * 4
@@ -58,38 +100,84 @@ ts = TileSystem(WIDTH, HEIGHT, LEFT, TOP, 9)
 def testGeoSearch(level, lngLeft, latTop):
     _, test, _ = ts.pos2Tile(level, ll2xy(lngLeft, latTop), True)
     list = []
-    for layer in test:
+    for layer, rectangle in zip(test, xy2ll_rectangles([test[layer] for layer in test]).tolist()):
         list.append({
             'name': layer,
-            'data': xy2ll_rectangle(test[layer]),
+            'data': rectangle,
         })
     return list
 
 
-def getTilesNames(level, lngLeft, latTop, lngRight, latBottom, dbgData = False):
-
-    nameTL = ts.pos2Tile(level, ll2xy(lngLeft, latTop))
-    nameBR = ts.pos2Tile(level, ll2xy(lngRight, latBottom))
+# tiles coordinates range (BasicTileSystem) covering the area
+def _tilesRange(level, lngLeft, latTop, lngRight, latBottom):
+    import numpy
+    xs, ys = ll2xy(numpy.array([lngLeft, lngRight]), numpy.array([latTop, latBottom]))
+    nameTL = ts.pos2Tile(level, [xs[0], ys[0]])
+    nameBR = ts.pos2Tile(level, [xs[1], ys[1]])
 
     simpleTs = BasicTileSystem(level - 8)
-    x1, y1 = simpleTs.tile2Pos(nameTL)
-    x2, y2 = simpleTs.tile2Pos(nameBR)
+    tileTL = Tile.fromName(nameTL)
+    tileBR = Tile.fromName(nameBR)
+    return simpleTs, tileTL.x, tileTL.y, tileBR.x, tileBR.y
 
-    list = []
-    for y in range(y1, y2 + 1):
-        for x in range(x1, x2 + 1):
-            tile = simpleTs.pos2Tile([x, y])
-
-            _, _, bbox = ts.pos2Tile(level, ts.tile2Pos(tile), True)
-            if dbgData:
-                list.append({
-                    'name': tile,
-                    'data': xy2ll_rectangle(bbox),
-                })
-            else:
-                list.append(tile)
 
+# bounding boxes [left, top, right, bottom] of tiles given by their coordinates
+def getTilesBBoxes(level, xs, ys):
+    import numpy
+    count = 2 ** (level - 8)
+    dx = ts.ROOT_TILE[2] / count
+    dy = ts.ROOT_TILE[3] / count
+    left = ts.ROOT_TILE[0] + numpy.asarray(xs) * dx
+    top = ts.ROOT_TILE[1] - numpy.asarray(ys) * dy
+    return numpy.stack([left, top, left + dx, top - dy], axis=-1)
+
+
+def getTilesNames(level, lngLeft, latTop, lngRight, latBottom, dbgData = False):
+    import numpy
+    simpleTs, x1, y1, x2, y2 = _tilesRange(level, lngLeft, latTop, lngRight, latBottom)
+    # corners swapped
+    if x2 < x1 or y2 < y1:
+        return []
+
+    # row by row, from the top left tile
+    ys, xs = numpy.mgrid[y1:y2 + 1, x1:x2 + 1]
+    xs = xs.ravel()
+    ys = ys.ravel()
+    names = simpleTs.pos2Tiles(xs, ys)
+    if not dbgData:
+        return names
+
+    list = []
+    for name, rectangle in zip(names, xy2ll_rectangles(getTilesBBoxes(level, xs, ys)).tolist()):
+        list.append({
+            'name': name,
+            'data': rectangle,
+        })
     return list
 
 
+# same as getTilesNames, as Tile
+def getTiles(level, lngLeft, latTop, lngRight, latBottom) -> List[Tile]:
+    import numpy
+    simpleTs, x1, y1, x2, y2 = _tilesRange(level, lngLeft, latTop, lngRight, latBottom)
+    if x2 < x1 or y2 < y1:
+        return []
+
+    ys, xs = numpy.mgrid[y1:y2 + 1, x1:x2 + 1]
+    codes = morton(xs.ravel().astype(numpy.uint64), ys.ravel().astype(numpy.uint64), simpleTs.level)
+    return [Tile(simpleTs.level, code) for code in codes.tolist()]
+
+
+# same as getTilesNames, but names are generated lazily, `rows` tiles rows at a time
+def iterTilesNames(level, lngLeft, latTop, lngRight, latBottom, rows=64) -> Iterator[str]:
+    import numpy
+    simpleTs, x1, y1, x2, y2 = _tilesRange(level, lngLeft, latTop, lngRight, latBottom)
+    if x2 < x1 or y2 < y1:
+        return
+
+    for y in range(y1, y2 + 1, rows):
+        ys, xs = numpy.mgrid[y:min(y + rows, y2 + 1), x1:x2 + 1]
+        yield from simpleTs.pos2Tiles(xs.ravel(), ys.ravel())
+
+
 # print(strll(xy2ll(*ts.tile2Pos("21130110310"))))
@@ -1,9 +1,23 @@
+import dataclasses
 import json
+import os
 import struct
 import math
+import multiprocessing
+import shutil
+import tempfile
+import crc32c
 import numpy
-from typing import List, Callable
-from pygltflib import *
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Callable, BinaryIO, Iterable, Iterator, Optional, Tuple
+from pygltflib import (
+    GLTF2, Accessor, Attributes, Buffer, BufferView, Image, Material, Mesh, Node, PbrMetallicRoughness,
+    Primitive, Sampler, Scene, Texture, TextureInfo, ARRAY_BUFFER, ELEMENT_ARRAY_BUFFER
+)
+from app.geo import xyz2llh, enuRotation
+from app.metrics import metrics
 
 @dataclass
 class Job:
@@ -11,15 +25,35 @@ class Job:
     blob: bytes
     center: List[float]
 
+# With `readahead`, the provider runs on that many threads for the next keys while the current job is
+# merged (downloads overlap decoding), at most `readahead` jobs being held ahead. Jobs come in keys order.
 class Jobs:
-  def __init__(self, keys: list[str], provider: Callable[[str], Optional[Job]]) -> None:
+  def __init__(self, keys: list[str], provider: Callable[[str], Optional[Job]], readahead: int = 0) -> None:
     self._keys = keys
     self._provider = provider
+    self._readahead = readahead
 
   def __iter__(self):
     self._idx = 0
+    if self._readahead > 0:
+      return self._pipeline()
     return self
 
+  def _pipeline(self) -> Iterator[Optional[Job]]:
+    with ThreadPoolExecutor(self._readahead) as executor:
+      pending = deque()
+      try:
+        for key in self._keys:
+          pending.append(executor.submit(self._provider, key))
+          if len(pending) >= self._readahead:
+            yield pending.popleft().result()
+        while pending:
+          yield pending.popleft().result()
+      finally:
+        # consumer gone: don't start the jobs not started yet
+        for future in pending:
+          future.cancel()
+
   def __next__(self):
     if self._idx < len(self._keys):
         i = self._idx
@@ -29,56 +63,173 @@ class Jobs:
       raise StopIteration
 
 
+# number of components for each accessor type
+ACCESSOR_TYPES = {
+    'SCALAR': 1,
+    'VEC2': 2,
+    'VEC3': 3,
+    'VEC4': 4,
+    'MAT2': 4,
+    'MAT3': 9,
+    'MAT4': 16,
+}
+
+# struct format of each accessor componentType
+COMPONENT_TYPES = {
+    5120: "b",  # signed byte 8bits
+    5121: "B",  # unsigned byte 8bits
+    5122: "h",  # signed short 16bits
+    5123: "H",  # unsigned short 16bits
+    5125: "I",  # unsigned int 32bits
+    5126: "f",  # signed float 32bits
+}
+
+
 def _getAccessorDataFormat(accessor: Accessor):
-    nbFields = 0
-    if accessor.type == 'SCALAR':
-        nbFields = 1
-    elif accessor.type == 'VEC3':
-        nbFields = 3
-    elif accessor.type == 'VEC2':
-        nbFields = 2
-    else:
+    if accessor.type not in ACCESSOR_TYPES:
         raise Exception("unsupported accessor type")
-
-    size = 0
-    unitaryFormat = ""
-    format = ""
-    if accessor.componentType == 5123:
-        # unsigned short 16bits
-        size = nbFields * 2
-        unitaryFormat = "<H"
-        format = "<" + "H" * nbFields
-    elif accessor.componentType == 5126:
-        # signed float 32bits
-        size = nbFields * 4
-        unitaryFormat = "<f"
-        format = "<" + "f" * nbFields
-    else:
+    if accessor.componentType not in COMPONENT_TYPES:
         raise Exception("unsupported accessor componentType")
 
+    nbFields = ACCESSOR_TYPES[accessor.type]
+    unitaryFormat = "<" + COMPONENT_TYPES[accessor.componentType]
+    componentSize = struct.calcsize(unitaryFormat)
+
+    # matrix columns start on 4-byte boundaries (MAT2/MAT3 of bytes, MAT3 of shorts)
+    columns = math.isqrt(nbFields) if accessor.type.startswith('MAT') else 1
+    rows = nbFields // columns
+    padding = -(rows * componentSize) % 4 if columns > 1 else 0
+    column = COMPONENT_TYPES[accessor.componentType] * rows + "x" * padding
+
+    size = columns * (rows * componentSize + padding)
+    format = "<" + column * columns
     return [size, format, unitaryFormat]
 
+
+def _readAccessorArray(accessor: Accessor, bufferView: BufferView, data: bytes) -> numpy.ndarray:
+    [size, _, unitaryFormat] = _getAccessorDataFormat(accessor)
+    dtype = numpy.dtype(unitaryFormat)
+
+    nbFields = ACCESSOR_TYPES[accessor.type]
+    columns = math.isqrt(nbFields) if accessor.type.startswith('MAT') else 1
+    columnSize = size // columns
+    stride = bufferView.byteStride or size
+    offset = (bufferView.byteOffset or 0) + (accessor.byteOffset or 0)
+
+    # typed view over the binary chunk, nothing is copied until the padding is dropped
+    view = numpy.ndarray(
+        shape=(accessor.count, columns, columnSize // dtype.itemsize),
+        dtype=dtype,
+        buffer=data,
+        offset=offset,
+        strides=(stride, columnSize, dtype.itemsize))
+    return view[:, :, :nbFields // columns].reshape(accessor.count, nbFields)
+
+
 class DynamicBuffer:
 
     def __init__(self):
         self.byteOffset = 0
         self.byteLength = 0
-        self.blobs : bytes = bytes()
+        # grows in place (amortized), the blobs are copied once and can be released by the caller
+        self.data = bytearray()
         self.bufferViews = []
+        # size of the EXT_meshopt_compression fallback buffer, where compressed bufferViews are decoded
+        self.fallbackLength = 0
+
+    @metrics.timed("append")
+    def append(self, blob: bytes, target: int = None, byteStride: int = None):
+        # each bufferView starts on a 4-byte boundary
+        self.data += bytes(-self.byteOffset % 4)
+        self.byteOffset = len(self.data)
+        self.data += blob
+        byteLength = len(blob)
+        self.bufferViews.append(BufferView(buffer=0, byteOffset=self.byteOffset, byteLength=byteLength, byteStride=byteStride, target=target))
+        self.byteOffset += byteLength
+        self.byteLength = self.byteOffset
+
+    # the compressed blob goes in the buffer, the bufferView itself points to the fallback buffer
+    def appendCompressed(self, blob: bytes, byteLength: int, target: int, byteStride: int, mode: str, count: int):
+        self.append(blob)
+        compressed = self.bufferViews.pop()
+        self.fallbackLength += -self.fallbackLength % 4
+        self.bufferViews.append(BufferView(
+            buffer=1, byteOffset=self.fallbackLength, byteLength=byteLength, target=target,
+            byteStride=byteStride if target == ARRAY_BUFFER else None,
+            extensions={"EXT_meshopt_compression": {
+                "buffer": 0, "byteOffset": compressed.byteOffset, "byteLength": compressed.byteLength,
+                "byteStride": byteStride, "mode": mode, "count": count}}))
+        self.fallbackLength += byteLength
+
+    def buffers(self) -> List[Buffer]:
+        buffers = [Buffer(byteLength=self.byteLength)]
+        if self.fallbackLength > 0:
+            buffers.append(Buffer(byteLength=self.fallbackLength, extensions={"EXT_meshopt_compression": {"fallback": True}}))
+        return buffers
+
+    def write(self, gltf: GLTF2):
+        # the BIN chunk length must be a multiple of 4 too
+        self.data += bytes(-len(self.data) % 4)
+        self.byteLength = len(self.data)
+        gltf.bufferViews = self.bufferViews
+        gltf.buffers = self.buffers()
+        gltf.set_binary_blob(self.data)
+
+
+# same as DynamicBuffer but the blobs are spilled to a temporary file as they come
+class FileBuffer(DynamicBuffer):
+
+    def __init__(self, dir: str = None):
+        DynamicBuffer.__init__(self)
+        self.file = tempfile.TemporaryFile(dir=dir)
 
-    def append(self, blob: bytes, target: int = None):
-        self.blobs += blob
+    @metrics.timed("append")
+    def append(self, blob: bytes, target: int = None, byteStride: int = None):
+        padding = -self.byteOffset % 4
+        self.file.write(bytes(padding))
+        self.byteOffset += padding
+        self.file.write(blob)
         byteLength = len(blob)
-        self.bufferViews.append(BufferView(buffer=0, byteOffset=self.byteOffset, byteLength=byteLength, target=target))
+        self.bufferViews.append(BufferView(buffer=0, byteOffset=self.byteOffset, byteLength=byteLength, byteStride=byteStride, target=target))
         self.byteOffset += byteLength
+        self.byteLength = self.byteOffset
 
     def write(self, gltf: GLTF2):
+        padding = -self.byteOffset % 4
+        self.file.write(bytes(padding))
+        self.byteLength = self.byteOffset + padding
         gltf.bufferViews = self.bufferViews
-        #gltf.buffers = [Buffer(byteLength=len(self.blobs))]
-        #gltf.set_binary_blob(self.blobs)        
-        padding : bytes = bytes([0,0,0,0])            
-        gltf.buffers = [Buffer(byteLength=len(self.blobs)+4)]
-        gltf.set_binary_blob(self.blobs + padding)
+        gltf.buffers = self.buffers()
+
+    def copyTo(self, output: BinaryIO):
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, output, 1 << 20)
+        self.file.close()
+
+
+# GLB container: header, JSON chunk and the BIN chunk header
+def glbHeader(gltf: GLTF2, binLength: int) -> List[bytes]:
+    jsonBlob = gltf.gltf_to_json(separators=(',', ':'), indent=None).encode("utf-8")
+    jsonBlob += b' ' * (-len(jsonBlob) % 4)
+    length = 12 + 8 + len(jsonBlob) + 8 + binLength
+    return [
+        b'glTF',
+        struct.pack('<I', 2),
+        struct.pack('<I', length),
+        struct.pack('<I', len(jsonBlob)),
+        b'JSON',
+        jsonBlob,
+        struct.pack('<I', binLength),
+        b'BIN\0',
+    ]
+
+
+# the binary blob goes as is in the BIN chunk
+# (GLTF2.save_to_bytes would re-pack every bufferView into yet another copy)
+def glbChunks(gltf: GLTF2) -> List[bytes]:
+    binBlob = gltf.binary_blob()
+    return glbHeader(gltf, len(binBlob)) + [binBlob]
+
 
 @dataclass
 class BlobAccessor:
@@ -98,117 +249,557 @@ class ReadData:
     texture: BlobImage
     sampler: Sampler
 
+# https://github.com/KhronosGroup/glTF/tree/main/specification/2.0#glb-file-format-specification
+# the GLB header and chunks are walked by hand (as _debugReadgltf does), the JSON is only decoded
+# as dict, and the BIN chunk is returned as a view over data
+def _readGlb(data: bytes) -> Tuple[dict, memoryview]:
+    view = memoryview(data)
+    i = 0
+    magic = bytes(view[i:i + 4])
+    i += 4
+    if not magic == b'glTF':
+        raise Exception('Invalid gltf format')
+    version = int.from_bytes(view[i:i + 4], "little")
+    i += 4
+    if not version == 2:
+        raise Exception('Invalid gltf version')
+    lenght = int.from_bytes(view[i:i + 4], "little")
+    i += 4
+    if not len(view) >= lenght:
+        raise Exception('Invalid size')
+
+    gltf = None
+    binary = None
+    while i < lenght:
+        chunkLenght = int.from_bytes(view[i:i + 4], "little")
+        i += 4
+        chunkType = bytes(view[i:i + 4])
+        i += 4
+        chunk = view[i:i + chunkLenght]
+        if chunkType == b'JSON':
+            gltf = json.loads(bytes(chunk))
+        elif chunkType == b'BIN\0':
+            binary = chunk
+        i += chunkLenght
+
+    if gltf is None or binary is None:
+        raise Exception('Invalid gltf chunks')
+    return gltf, binary
+
+
+# pygltflib object from its JSON, unknown properties are dropped
+def _load(cls, fields: dict):
+    return cls(**{k: v for k, v in fields.items() if k in cls.__dataclass_fields__})
+
+
+# and back, without the unset properties
+def jsonFields(obj) -> dict:
+    return {k: v for k, v in dataclasses.asdict(obj).items() if v is not None and v != {}}
+
+
+# only what concatenate uses is read: one mesh, one primitive, one image and one sampler
+# blobs are views over data whenever they are contiguous in it
+@metrics.timed("readGltf")
 def readGltf(data: bytes) -> ReadData:
 
-    gltf = GLTF2().load_from_bytes(data)
+    gltf, binary = _readGlb(data)
 
     def readBlobAccessor(accessorIndex: int) -> BlobAccessor:
-        accessor = gltf.accessors[accessorIndex]
-        [size, format, unitaryFormat] = _getAccessorDataFormat(accessor)
-
-        bufferView = gltf.bufferViews[accessor.bufferView]
-        buffer = gltf.buffers[bufferView.buffer]
-        data = gltf.get_data_from_buffer_uri(buffer.uri)
-        list = []
-        for i in range(accessor.count):
-            index = bufferView.byteOffset + accessor.byteOffset + i * size
-            d = data[index:index + size]
-            v = struct.unpack(format , d)
-            list.append(v)
-        npList = numpy.array(list, dtype=unitaryFormat)
-
-        blob = npList.tobytes()
+        accessor = _load(Accessor, gltf['accessors'][accessorIndex])
+        bufferView = _load(BufferView, gltf['bufferViews'][accessor.bufferView])
+        npList = _readAccessorArray(accessor, bufferView, binary)
+
+        blob = memoryview(npList).cast('B') if npList.flags.c_contiguous else npList.tobytes()
         assert(accessor.count == len(npList))
         #assert(accessor.max == npList.max(axis=0).tolist())
         #assert(accessor.min == npList.min(axis=0).tolist())
-        return BlobAccessor(blob, accessor)
+        # the blob is packed, it starts its own bufferView
+        return BlobAccessor(blob, dataclasses.replace(accessor, byteOffset=0))
 
     def readBlobImage(imageIndex: int) -> BlobImage:
-        image = gltf.images[imageIndex]
-        bufferView = gltf.bufferViews[image.bufferView]
-        buffer = gltf.buffers[bufferView.buffer]
-        data = gltf.get_data_from_buffer_uri(buffer.uri)
-        blob = data[bufferView.byteOffset: bufferView.byteOffset+bufferView.byteLength]
+        image = _load(Image, gltf['images'][imageIndex])
+        bufferView = gltf['bufferViews'][image.bufferView]
+        byteOffset = bufferView.get('byteOffset', 0)
+        blob = binary[byteOffset:byteOffset + bufferView['byteLength']]
         return BlobImage(blob, image)
 
+    mesh = gltf['meshes'][gltf['scenes'][gltf.get('scene', 0)]['nodes'][0]]
+    primitive = mesh['primitives'][0]
 
-    mesh = gltf.meshes[gltf.scenes[gltf.scene].nodes[0]]
-    primitive = mesh.primitives[0]
-    
-    points = readBlobAccessor(primitive.attributes.POSITION)
-    textCoord0 = readBlobAccessor(primitive.attributes.TEXCOORD_0)
-    indices = readBlobAccessor(primitive.indices)
+    points = readBlobAccessor(primitive['attributes']['POSITION'])
+    textCoord0 = readBlobAccessor(primitive['attributes']['TEXCOORD_0'])
+    indices = readBlobAccessor(primitive['indices'])
     texture = readBlobImage(0)
-    sampler = gltf.samplers[0]
+    sampler = _load(Sampler, gltf['samplers'][0])
     return ReadData(points, textCoord0, indices, texture, sampler)
 
 
-def concatenate(jobs: Jobs):
+# readGltf for the process pool: views can't be pickled, blobs are copied out of data
+def _readGltfBytes(data: bytes) -> ReadData:
+    input = readGltf(data)
+    for blob in [input.points, input.textCoord0, input.indices, input.texture]:
+        blob.blob = bytes(blob.blob)
+    return input
+
+
+# decode the jobs' glTF, with a pool of `workers` processes when > 1
+# tiles come back in jobs order, with at most 2 * workers of them in flight
+# `cache` (a DecodedTileCache) is looked up first, and gets the newly decoded tiles
+# jobs for which `reuse` is true are not decoded at all, and come back without data
+def decodeJobs(jobs: Iterable[Optional[Job]], workers: int = 0, cache=None,
+               reuse: Callable[[Job], bool] = None) -> Iterator[Tuple[Optional[Job], Optional[ReadData]]]:
+
+    def cached(job: Job) -> Optional[ReadData]:
+        return None if cache is None else cache.get(job.key, job.blob)
+
+    def stored(job: Job, data: ReadData) -> ReadData:
+        if cache is not None:
+            cache.put(job.key, job.blob, data)
+        return data
+
+    if workers <= 1:
+        for job in jobs:
+            if job is None:
+                yield None, None
+                continue
+            if reuse is not None and reuse(job):
+                yield job, None
+                continue
+            data = cached(job)
+            yield job, data if data is not None else stored(job, readGltf(job.blob))
+        return
+
+    # spawned, not forked: the jobs come from running threads (Jobs readahead), a lock one of them
+    # holds at fork time (e.g. metrics) would stay held forever in the worker
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = deque()
+
+        def pop():
+            job, data, future = pending.popleft()
+            if future is not None:
+                # the decoding itself is timed in the workers, unseen here
+                with metrics.timer("readGltf.wait"):
+                    data = stored(job, future.result())
+            return job, data
+
+        for job in jobs:
+            if job is not None and reuse is not None and reuse(job):
+                pending.append((job, None, None))
+            else:
+                data = None if job is None else cached(job)
+                future = None if job is None or data is not None else executor.submit(_readGltfBytes, job.blob)
+                pending.append((job, data, future))
+            if len(pending) >= 2 * workers:
+                yield pop()
+        while pending:
+            yield pop()
+
+
+# KHR_mesh_quantization: positions as int16 over their bounds, padded to 4 components (vertex
+# attributes are 4-byte aligned), with the offset and scale of the node bringing them back
+def quantizePositions(points: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    low = points.min(axis=0).astype(numpy.float64)
+    extent = points.max(axis=0) - low
+    scale = numpy.where(extent > 0, extent / 65535, 1)
+    quantized = numpy.zeros((len(points), 4), dtype="<i2")
+    quantized[:, :3] = numpy.round((points - low) / scale) - 32768
+    return quantized, low + 32768 * scale, scale
+
+
+# texture coordinates as normalized uint16, None if out of [0, 1]
+def quantizeTextCoords(textCoord0: numpy.ndarray) -> Optional[numpy.ndarray]:
+    if textCoord0.size > 0 and (textCoord0.min() < 0 or textCoord0.max() > 1):
+        return None
+    return numpy.round(textCoord0 * 65535).astype("<u2")
+
+
+ENCODINGS = ["float", "quantized", "meshopt"]
+
+# tiles glTF (y-up) to their ECEF axes (z-up), as 3D Tiles does
+Y_UP_TO_Z_UP = numpy.array([[1, 0, 0], [0, 0, -1], [0, 1, 0]])
+# East North Up to the merged glTF: x east, y up, z south
+ENU_TO_Y_UP = numpy.array([[1, 0, 0], [0, 0, 1], [0, -1, 0]])
+
+
+# root node matrix (column major): tiles are placed around the origin with their ECEF axes,
+# then turned to the origin East North Up frame, wherever the area is
+def enuMatrix(origin: List[float]) -> List[float]:
+    lat, lng, _ = xyz2llh(*origin)
+    matrix = numpy.identity(4)
+    matrix[:3, :3] = ENU_TO_Y_UP @ enuRotation(lat, lng) @ Y_UP_TO_Z_UP
+    return matrix.T.ravel().tolist()
+
+
+# with an output file, the merge is streamed: tiles payloads are spilled to a temporary file (in
+# `spill`, the system temporary directory by default) and only the glTF JSON is kept in memory,
+# otherwise the GLB chunks are returned
+# with `atlas` (a page size), the JPEG textures are packed on shared atlas pages (see app.atlas),
+# so that the tiles on a page share one texture and one material
+# with `merge`, the tiles translations are baked into their positions and the tiles sharing a
+# material are merged into a single primitive, all of them under a single mesh and node
+# `encoding` is one of ENCODINGS: float as read, quantized positions and texture coordinates, or
+# quantized then compressed with EXT_meshopt_compression (see app.meshopt)
+# with an output file, each tile place in the GLB is returned as a manifest (without atlas nor merge),
+# given back as `previous` with the GLB file, unchanged tiles are copied from there instead of decoded
+def concatenate(jobs: Jobs, output: BinaryIO = None, workers: int = 0, cache=None, atlas: int = 0, merge: bool = False,
+                encoding: str = "float", previous: Tuple[BinaryIO, dict] = None, spill: str = None):
 
     gltf = GLTF2()
-    buffer = DynamicBuffer()
-    nodeIdx = 0
+    buffer = DynamicBuffer() if output is None else FileBuffer(spill)
     origin = None
     children = []
+    # identical samplers are merged, atlas pages images are written when they are complete
+    samplers = {}
+    pages = {}
+    packer = None
+    if atlas > 0:
+        from app.atlas import Atlas
+        packer = Atlas(atlas)
+
+    # tiles of the previous merge, and of this one
+    options = {'encoding': encoding}
+    tiles = None if output is None or packer is not None or merge else []
+    reusable = {}
+    if tiles is not None and previous is not None and previous[1]['options'] == options:
+        reusable = {tile['key']: tile for tile in previous[1]['tiles']}
+
+    def source(job: Job) -> List[int]:
+        return [len(job.blob), crc32c.crc32c(job.blob)]
+
+    def reuse(job: Job) -> bool:
+        return job.key in reusable and reusable[job.key]['source'] == source(job)
+
+    # material -> positions, texture coordinates and indices of the tiles to merge
+    groups = {}
+    primitives = []
+    extensions = set()
+    if encoding == "meshopt":
+        from app.meshopt import encodeVertexBuffer, encodeIndexSequence
+
+    # the inputs are copied, not changed: a decoded tile may be merged by others (app.server)
+    def addAccessor(input: BlobAccessor, target: int) -> int:
+        accessor = dataclasses.replace(input.accessor, bufferView=len(buffer.bufferViews))
+        buffer.append(input.blob, target)
+        gltf.accessors.append(accessor)
+        return len(gltf.accessors) - 1
+
+    def addArray(array: numpy.ndarray, accessor: Accessor, target: int, byteStride: int = None) -> int:
+        accessor.bufferView = len(buffer.bufferViews)
+        if encoding != "meshopt":
+            buffer.append(memoryview(numpy.ascontiguousarray(array)).cast('B'), target, byteStride)
+        elif target == ELEMENT_ARRAY_BUFFER:
+            buffer.appendCompressed(encodeIndexSequence(array), array.nbytes, target, array.itemsize, "INDICES", len(array))
+        else:
+            vertices = numpy.ascontiguousarray(array).view(numpy.uint8).reshape(len(array), -1)
+            buffer.appendCompressed(encodeVertexBuffer(vertices), array.nbytes, target, vertices.shape[1], "ATTRIBUTES", len(array))
+        gltf.accessors.append(accessor)
+        return len(gltf.accessors) - 1
+
+    # primitive with its own accessors, and the node translation and scale its positions need (quantized)
+    def addPrimitive(points: numpy.ndarray, textCoord0: numpy.ndarray, indices: numpy.ndarray, material: int):
+        offset, scale = None, None
+        if encoding == "float":
+            POSITION = addArray(points, Accessor(
+                componentType=5126, count=len(points), type="VEC3",
+                min=points.min(axis=0).tolist(), max=points.max(axis=0).tolist()), ARRAY_BUFFER)
+        else:
+            quantized, offset, scale = quantizePositions(points)
+            POSITION = addArray(quantized, Accessor(
+                componentType=5122, count=len(points), type="VEC3",
+                min=quantized[:, :3].min(axis=0).tolist(), max=quantized[:, :3].max(axis=0).tolist()), ARRAY_BUFFER, 8)
+            extensions.add("KHR_mesh_quantization")
+
+        quantized = None if encoding == "float" else quantizeTextCoords(textCoord0)
+        if quantized is None:
+            TEXCOORD_0 = addArray(textCoord0.astype("<f4"), Accessor(componentType=5126, count=len(textCoord0), type="VEC2"), ARRAY_BUFFER)
+        else:
+            TEXCOORD_0 = addArray(quantized, Accessor(componentType=5123, normalized=True, count=len(textCoord0), type="VEC2"), ARRAY_BUFFER)
+
+        # the index codec takes 16 or 32 bits indices
+        if encoding == "meshopt" and indices.dtype.itemsize == 1:
+            indices = indices.astype("<u2")
+        componentType = {1: 5121, 2: 5123, 4: 5125}[indices.dtype.itemsize]
+        primitive = Primitive(
+            attributes=Attributes(POSITION=POSITION, TEXCOORD_0=TEXCOORD_0),
+            indices=addArray(indices, Accessor(componentType=componentType, count=len(indices), type="SCALAR"), ELEMENT_ARRAY_BUFFER),
+            material=material)
+        return primitive, offset, scale
+
+    def addSampler(sampler: Sampler) -> int:
+        key = (sampler.magFilter, sampler.minFilter, sampler.wrapS, sampler.wrapT)
+        if key not in samplers:
+            samplers[key] = len(gltf.samplers)
+            gltf.samplers.append(sampler)
+        return samplers[key]
+
+    def addMaterial(image: Image, sampler: Sampler) -> int:
+        gltf.images.append(image)
+        gltf.textures.append(Texture(sampler=addSampler(sampler), source=len(gltf.images) - 1))
+        gltf.materials.append(Material(
+            alphaCutoff=None,
+            pbrMetallicRoughness=PbrMetallicRoughness(baseColorTexture=TextureInfo(index=len(gltf.textures) - 1))))
+        return len(gltf.materials) - 1
+
+    def writePages(final: bool = False):
+        for page, blob in packer.flush(final):
+            gltf.images[pages[page][0]].bufferView = len(buffer.bufferViews)
+            buffer.append(blob)
+            # nothing else goes on this page
+            writeGroup(pages[page][1])
+
+    def writeGroup(material: int):
+        if material not in groups:
+            return
+        points, textCoords0, indices = zip(*groups.pop(material))
+        points = numpy.concatenate(points)
+        textCoord0 = numpy.concatenate(textCoords0)
+        # indices are rebased on the tile first vertex, the largest index value is reserved (primitive restart)
+        starts = numpy.cumsum([0] + [len(p) for p in textCoords0[:-1]])
+        dtype = numpy.dtype("<u2") if len(points) < 65535 else numpy.dtype("<u4")
+        indices = numpy.concatenate([i.astype(dtype) + dtype.type(start) for i, start in zip(indices, starts)])
+
+        primitive, offset, scale = addPrimitive(points, textCoord0, indices, material)
+        if offset is None:
+            primitives.append(primitive)
+        else:
+            # quantized over the group bounds, with its own node
+            gltf.meshes.append(Mesh(primitives=[primitive]))
+            gltf.nodes.append(Node(mesh=len(gltf.meshes) - 1, translation=offset.tolist(), scale=scale.tolist()))
+            children.append(len(gltf.nodes) - 1)
+
+    # only float positions and texture coordinates are merged (or quantized), other tiles are left as is
+    def mergeable(input: ReadData) -> bool:
+        return (input.points.accessor.componentType == 5126 and input.points.accessor.type == 'VEC3'
+                and input.textCoord0.accessor.componentType == 5126 and input.textCoord0.accessor.type == 'VEC2'
+                and input.indices.accessor.componentType in [5121, 5123, 5125])
+
+    # atlas page material and remapped texture coordinates, None if the tile keeps its own texture
+    def packTexture(input: ReadData) -> Optional[Tuple[int, BlobAccessor]]:
+        accessor = input.textCoord0.accessor
+        if input.texture.image.mimeType != "image/jpeg" or accessor.componentType != 5126 or accessor.type != 'VEC2':
+            return None
+        textCoord0 = numpy.frombuffer(input.textCoord0.blob, dtype="<f4").reshape(-1, 2)
+        placed = packer.add(input.texture.blob, textCoord0)
+        if placed is None:
+            return None
+        page, textCoord0 = placed
+        if page not in pages:
+            # the page image gets its bufferView once written
+            sampler = Sampler(magFilter=input.sampler.magFilter, minFilter=input.sampler.minFilter, wrapS=33071, wrapT=33071)
+            pages[page] = (len(gltf.images), addMaterial(Image(mimeType="image/jpeg"), sampler))
+        writePages()
+        if accessor.min is not None:
+            accessor = dataclasses.replace(accessor, min=textCoord0.min(axis=0).tolist(), max=textCoord0.max(axis=0).tolist())
+        return pages[page][1], BlobAccessor(memoryview(textCoord0).cast('B'), accessor)
+
+    def arrays(input: ReadData) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        return (numpy.frombuffer(input.points.blob, dtype="<f4").reshape(-1, 3),
+                numpy.frombuffer(input.textCoord0.blob, dtype="<f4").reshape(-1, 2),
+                numpy.frombuffer(input.indices.blob, dtype="<" + COMPONENT_TYPES[input.indices.accessor.componentType]))
+
+    # the tile bufferViews are copied as they are, their accessors, image... only get new indices
+    def copyTile(tile: dict, translation: List[float]) -> Node:
+        old, manifest = previous
+        bufferView = len(buffer.bufferViews)
+        for view in tile['bufferViews']:
+            view = _load(BufferView, view)
+            compressed = (view.extensions or {}).get("EXT_meshopt_compression")
+            old.seek(manifest['bin'] + (view.byteOffset if compressed is None else compressed['byteOffset']))
+            if compressed is None:
+                buffer.append(old.read(view.byteLength), view.target, view.byteStride)
+            else:
+                buffer.appendCompressed(old.read(compressed['byteLength']), view.byteLength, view.target,
+                                        compressed['byteStride'], compressed['mode'], compressed['count'])
+        accessor = len(gltf.accessors)
+        for fields in tile['accessors']:
+            gltf.accessors.append(_load(Accessor, {**fields, 'bufferView': bufferView + fields['bufferView']}))
+        if any(a.componentType != 5126 for a in gltf.accessors[accessor:] if a.type != 'SCALAR'):
+            extensions.add("KHR_mesh_quantization")
+        image = _load(Image, {**tile['image'], 'bufferView': bufferView + tile['image']['bufferView']})
+        primitive = tile['primitive']
+        gltf.meshes.append(Mesh(primitives=[Primitive(
+            attributes=Attributes(POSITION=accessor + primitive['POSITION'], TEXCOORD_0=accessor + primitive['TEXCOORD_0']),
+            indices=accessor + primitive['indices'],
+            material=addMaterial(image, _load(Sampler, tile['sampler'])))]))
+        return Node(mesh=len(gltf.meshes) - 1, translation=(numpy.array(translation) + tile['offset']).tolist(), scale=tile.get('scale'), name=tile['key'])
+
+    # where the tile went, relative to its first bufferView and accessor
+    def tileEntry(job: Job, node: Node, offset: List[float], bufferView: int, accessor: int) -> dict:
+        primitive = gltf.meshes[node.mesh].primitives[0]
+        texture = gltf.textures[gltf.materials[primitive.material].pbrMetallicRoughness.baseColorTexture.index]
+        image = gltf.images[texture.source]
+        return {
+            'key': job.key,
+            'source': source(job),
+            'bufferViews': [jsonFields(view) for view in buffer.bufferViews[bufferView:]],
+            'accessors': [{**jsonFields(a), 'bufferView': a.bufferView - bufferView} for a in gltf.accessors[accessor:]],
+            'image': {**jsonFields(image), 'bufferView': image.bufferView - bufferView},
+            'sampler': jsonFields(gltf.samplers[texture.sampler]),
+            'primitive': {
+                'POSITION': primitive.attributes.POSITION - accessor,
+                'TEXCOORD_0': primitive.attributes.TEXCOORD_0 - accessor,
+                'indices': primitive.indices - accessor,
+            },
+            # node translation besides the tile one (quantization)
+            'offset': offset,
+            **({} if node.scale is None else {'scale': node.scale}),
+        }
+
+    for job, input in decodeJobs(jobs, workers, cache, reuse if reusable else None):
 
-    for job in iter(jobs):
-        
         # missing tile ?
         if job is None:
             continue
-        
-        if origin is None:
-            origin = job.center
-
-        input = readGltf(job.blob)
-        input.points.accessor.bufferView = nodeIdx*4 + 0 
-        input.textCoord0.accessor.bufferView = nodeIdx*4 + 1
-        input.indices.accessor.bufferView = nodeIdx*4 + 2
-        input.texture.image.bufferView = nodeIdx*4 + 3
-        
-        gltf.accessors.append(input.points.accessor)
-        gltf.accessors.append(input.textCoord0.accessor)
-        gltf.accessors.append(input.indices.accessor)
-
-        gltf.images.append(input.texture.image)
-        gltf.samplers.append(input.sampler)
-        gltf.textures.append(Texture(sampler=nodeIdx, source=nodeIdx))
-        gltf.materials.append(Material(
-            alphaCutoff=None,
-            pbrMetallicRoughness=PbrMetallicRoughness(baseColorTexture=TextureInfo(index=nodeIdx))))
-
-        buffer.append(input.points.blob, ARRAY_BUFFER)
-        buffer.append(input.textCoord0.blob, ARRAY_BUFFER)
-        buffer.append(input.indices.blob, ELEMENT_ARRAY_BUFFER)
-        buffer.append(input.texture.blob)
-
-        gltf.meshes.append(Mesh(
-                primitives=[
-                    Primitive(
-                        attributes=Attributes(POSITION=nodeIdx*3 + 0 , TEXCOORD_0=nodeIdx*3 + 1),
-                        indices=nodeIdx*3 + 2,
-                        material=nodeIdx 
-                    )
-                ]
-            )
-        )
 
-        translation = [job.center[0]-origin[0], job.center[2]-origin[2], -(job.center[1]-origin[1])]
+        if origin is None:
+            origin = numpy.array(job.center, dtype=numpy.float64)
+
+        if input is None:
+            translation = (Y_UP_TO_Z_UP.T @ (numpy.array(job.center) - origin)).tolist()
+            bufferView, accessor = len(buffer.bufferViews), len(gltf.accessors)
+            gltf.nodes.append(copyTile(reusable[job.key], translation))
+            children.append(len(gltf.nodes) - 1)
+            tiles.append(tileEntry(job, gltf.nodes[-1], reusable[job.key]['offset'], bufferView, accessor))
+            continue
 
-        gltf.nodes.append(Node(mesh=nodeIdx, translation=translation, name=job.key))
-        children.append(nodeIdx)
-        nodeIdx +=1
+        packed = None if packer is None else packTexture(input)
+        if packed is not None:
+            material, textCoord0 = packed
+            input = dataclasses.replace(input, textCoord0=textCoord0)
+
+        translation = (Y_UP_TO_Z_UP.T @ (numpy.array(job.center) - origin)).tolist()
+
+        if merge and mergeable(input):
+            if packed is None:
+                image = dataclasses.replace(input.texture.image, bufferView=len(buffer.bufferViews))
+                buffer.append(input.texture.blob)
+                material = addMaterial(image, input.sampler)
+            points, textCoord0, indices = arrays(input)
+            groups.setdefault(material, []).append(((points + numpy.array(translation)).astype("<f4"), textCoord0, indices))
+            # a tile own material won't get other tiles
+            if packed is None:
+                writeGroup(material)
+            continue
 
-    angle = math.pi * (90 - 50.63790367370581)/360
-    gltf.nodes.append(Node(children=children, rotation=[0, 0, angle, 1]))
+        bufferView, accessor = len(buffer.bufferViews), len(gltf.accessors)
+        offset = numpy.zeros(3)
+        scale = None
+        if encoding == "float" or not mergeable(input):
+            POSITION = addAccessor(input.points, ARRAY_BUFFER)
+            TEXCOORD_0 = addAccessor(input.textCoord0, ARRAY_BUFFER)
+            indices = addAccessor(input.indices, ELEMENT_ARRAY_BUFFER)
+            primitive = None
+        else:
+            primitive, offset, scale = addPrimitive(*arrays(input), None)
+            translation = (numpy.array(translation) + offset).tolist()
+            scale = scale.tolist()
+
+        if packed is None:
+            image = dataclasses.replace(input.texture.image, bufferView=len(buffer.bufferViews))
+            buffer.append(input.texture.blob)
+            material = addMaterial(image, input.sampler)
+
+        if primitive is None:
+            primitive = Primitive(
+                attributes=Attributes(POSITION=POSITION, TEXCOORD_0=TEXCOORD_0),
+                indices=indices,
+                material=material
+            )
+        primitive.material = material
+        gltf.meshes.append(Mesh(primitives=[primitive]))
+
+        gltf.nodes.append(Node(mesh=len(gltf.meshes) - 1, translation=translation, scale=scale, name=job.key))
+        children.append(len(gltf.nodes) - 1)
+        if tiles is not None:
+            tiles.append(tileEntry(job, gltf.nodes[-1], offset.tolist(), bufferView, accessor))
+
+    if packer is not None:
+        writePages(True)
+    for material in list(groups):
+        writeGroup(material)
+    if primitives:
+        gltf.meshes.append(Mesh(primitives=primitives))
+        gltf.nodes.append(Node(mesh=len(gltf.meshes) - 1))
+        children.append(len(gltf.nodes) - 1)
+
+    if encoding == "meshopt" and buffer.fallbackLength > 0:
+        extensions.add("EXT_meshopt_compression")
+    gltf.extensionsUsed = sorted(extensions)
+    gltf.extensionsRequired = sorted(extensions)
+
+    gltf.nodes.append(Node(children=children, matrix=None if origin is None else enuMatrix(origin)))
 
     # add the whole buffer at once ?
     buffer.write(gltf)
 
-    gltf.scenes.append(Scene(nodes=[nodeIdx]))
+    gltf.scenes.append(Scene(nodes=[len(gltf.nodes) - 1]))
     gltf.scene = 0
-            
-    return gltf.save_to_bytes()
+
+    with metrics.timer("serialize"):
+        if output is None:
+            chunks = glbChunks(gltf)
+            metrics.count("glbBytes", sum(len(chunk) for chunk in chunks))
+            return chunks
+
+        header = glbHeader(gltf, buffer.byteLength)
+        for data in header:
+            output.write(data)
+        buffer.copyTo(output)
+    metrics.count("glbBytes", sum(len(data) for data in header) + buffer.byteLength)
+
+    if tiles is None:
+        return None
+    headerLength = sum(len(data) for data in header)
+    return {
+        'version': 2,
+        'options': options,
+        'bin': headerLength,
+        'length': headerLength + buffer.byteLength,
+        'tiles': tiles,
+    }
+
+
+# merge into the GLB at path, its manifest being next to it (path.manifest.json)
+# when incremental, the tiles unchanged since the previous merge there are copied instead of decoded
+def concatenateFile(jobs: Jobs, path: str, workers: int = 0, cache=None, atlas: int = 0, merge: bool = False,
+                    encoding: str = "float", incremental: bool = False):
+    manifestPath = path + ".manifest.json"
+    previous = None
+    if incremental:
+        try:
+            with open(manifestPath) as f:
+                manifest = json.load(f)
+            old = open(path, "rb")
+            # a manifest of another GLB is ignored
+            if manifest.get('version') == 2 and os.fstat(old.fileno()).st_size == manifest['length']:
+                previous = (old, manifest)
+            else:
+                old.close()
+        except (OSError, ValueError, KeyError):
+            pass
+
+    # written next to it then renamed (not with mkstemp, the GLB gets the usual permissions)
+    tmp = f"{path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp, "wb") as f:
+            # spilled next to the output: the system temporary directory may well be in memory (tmpfs)
+            manifest = concatenate(jobs, f, workers, cache, atlas, merge, encoding, previous, os.path.dirname(os.path.abspath(path)))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    finally:
+        if previous is not None:
+            previous[0].close()
+
+    # no manifest while the GLB is replaced, an interrupted run falls back to a full merge
+    if os.path.exists(manifestPath):
+        os.unlink(manifestPath)
+    os.replace(tmp, path)
+    if manifest is not None:
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, separators=(',', ':'))
+        os.replace(tmp, manifestPath)
 
 
 #print(json.dumps(readgltf("merge.glb")))
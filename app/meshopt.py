@@ -0,0 +1,184 @@
+import numpy
+
+from app.metrics import metrics
+
+# meshoptimizer vertex and index sequence codecs, as EXT_meshopt_compression expects them
+# (vertex codec version 0, index codec version 1), encoded with numpy only
+#
+# https://github.com/KhronosGroup/glTF/tree/main/extensions/2.0/Vendor/EXT_meshopt_compression
+# https://github.com/zeux/meshoptimizer/blob/master/src/vertexcodec.cpp
+# https://github.com/zeux/meshoptimizer/blob/master/src/indexcodec.cpp
+
+VERTEX_HEADER = 0xa0
+SEQUENCE_HEADER = 0xd1
+
+BLOCK_SIZE_BYTES = 8192
+BLOCK_MAX_SIZE = 256
+GROUP_SIZE = 16
+TAIL_MAX_SIZE = 32
+
+
+def _zigzag8(deltas: numpy.ndarray) -> numpy.ndarray:
+    return (((deltas << 1) ^ -(deltas >> 7)) & 0xff).astype(numpy.uint8)
+
+
+# vertices is a (count, stride) array of bytes, stride a multiple of 4 up to 256
+#
+# Each vertex byte is delta encoded from the previous vertex, zigzagged, then stored byte by byte
+# (all the vertices first bytes, then the second ones...) for blocks of up to 256 vertices.
+# Bytes go by groups of 16, each one 0 (all zeros), 2 or 4 bits wide (with the largest value
+# escaping to a full byte stored after them), or raw, as given by 2 bits in the group header.
+@metrics.timed("meshopt")
+def encodeVertexBuffer(vertices: numpy.ndarray) -> bytes:
+    count, stride = vertices.shape
+    assert(stride % 4 == 0 and stride <= 256)
+    vertices = numpy.ascontiguousarray(vertices, dtype=numpy.uint8)
+    tail = bytes(max(0, TAIL_MAX_SIZE - stride)) + (vertices[0].tobytes() if count > 0 else bytes(stride))
+    if count == 0:
+        return bytes([VERTEX_HEADER]) + tail
+
+    blockSize = min(BLOCK_MAX_SIZE, (BLOCK_SIZE_BYTES // stride) & ~(GROUP_SIZE - 1))
+    blocks = -(-count // blockSize)
+    groups = blockSize // GROUP_SIZE
+    # each header byte has 4 groups
+    headerSize = -(-groups // 4)
+
+    # deltas from the previous vertex, the first vertex (in the tail) being the first predecessor
+    deltas = _zigzag8(numpy.diff(vertices.astype(numpy.int16), axis=0, prepend=vertices[:1]) & 0xff)
+
+    # the last block is padded to a whole group with its last value
+    lastCount = count - (blocks - 1) * blockSize
+    lastGroups = -(-lastCount // GROUP_SIZE)
+    padded = numpy.empty((blocks * blockSize, stride), dtype=numpy.uint8)
+    padded[:count] = deltas
+    padded[count:] = deltas[-1]
+    # (block, vertex byte, group, 16 values)
+    values = padded.reshape(blocks, groups, GROUP_SIZE, stride).transpose(0, 3, 1, 2)
+    validGroups = numpy.ones((blocks, 1, groups), dtype=bool)
+    validGroups[-1, 0, lastGroups:] = False
+
+    # smallest encoding of each group
+    sizes = numpy.stack([
+        numpy.where((values == 0).all(axis=-1), 0, 1 << 16),
+        4 + (values >= 3).sum(axis=-1),
+        8 + (values >= 15).sum(axis=-1),
+        numpy.full(values.shape[:-1], 16),
+    ])
+    modes = sizes.argmin(axis=0).astype(numpy.uint8)
+
+    # header: 2 bits per group, from the low bits
+    headerModes = numpy.zeros((blocks, stride, headerSize * 4), dtype=numpy.uint8)
+    headerModes[:, :, :groups] = modes
+    header = (headerModes.reshape(blocks, stride, headerSize, 4) << numpy.array([0, 2, 4, 6], dtype=numpy.uint8)).sum(axis=-1, dtype=numpy.uint8)
+    validHeader = numpy.ones((blocks, stride, headerSize), dtype=bool)
+    validHeader[-1, :, -(-lastGroups // 4):] = False
+
+    # groups: packed values slot then escaped values slot, 16 bytes each
+    bits2 = numpy.minimum(values, 3).reshape(*values.shape[:-1], 4, 4) << numpy.array([6, 4, 2, 0], dtype=numpy.uint8)
+    bits4 = numpy.minimum(values, 15).reshape(*values.shape[:-1], 8, 2) << numpy.array([4, 0], dtype=numpy.uint8)
+    packed = numpy.where(modes[..., None] == 1, numpy.pad(bits2.sum(axis=-1, dtype=numpy.uint8), [(0, 0)] * 3 + [(0, 12)]),
+                         numpy.where(modes[..., None] == 2, numpy.pad(bits4.sum(axis=-1, dtype=numpy.uint8), [(0, 0)] * 3 + [(0, 8)]), values))
+    validPacked = numpy.arange(GROUP_SIZE) < numpy.array([0, 4, 8, 16], dtype=numpy.int64)[modes][..., None]
+    validEscaped = ((modes[..., None] == 1) & (values >= 3)) | ((modes[..., None] == 2) & (values >= 15))
+    groupData = numpy.concatenate([packed, values], axis=-1)
+    validData = numpy.concatenate([validPacked, validEscaped], axis=-1) & validGroups[..., None]
+
+    # blocks, then vertex bytes: header, then groups
+    data = numpy.concatenate([header, groupData.reshape(blocks, stride, -1)], axis=-1)
+    valid = numpy.concatenate([validHeader, validData.reshape(blocks, stride, -1)], axis=-1)
+    return bytes([VERTEX_HEADER]) + data[valid].tobytes() + tail
+
+
+# the indices, delta encoded from the previous one as zigzagged varints
+# (the codec may switch between two baselines, only the first one is used here)
+@metrics.timed("meshopt")
+def encodeIndexSequence(indices: numpy.ndarray) -> bytes:
+    indices = numpy.asarray(indices, dtype=numpy.uint32).ravel()
+    # 32 bits wrapping deltas
+    deltas = (numpy.diff(indices.astype(numpy.int64), prepend=0) & 0xffffffff).astype(numpy.uint32).view(numpy.int32).astype(numpy.int64)
+    # zigzag, then the low bit is the baseline (0)
+    v = ((deltas << 1) ^ (deltas >> 63)).astype(numpy.uint64) & 0xffffffff
+    v = (v << 1) & 0xffffffff
+
+    # little endian base 128, up to 5 bytes
+    shifts = numpy.arange(5, dtype=numpy.uint64) * 7
+    length = 1 + (v[:, None] >= (numpy.uint64(1) << shifts[1:])).sum(axis=-1)
+    varints = ((v[:, None] >> shifts) & 127).astype(numpy.uint8)
+    varints |= ((numpy.arange(5) < (length - 1)[:, None]) << 7).astype(numpy.uint8)
+    valid = numpy.arange(5) < length[:, None]
+    return bytes([SEQUENCE_HEADER]) + varints[valid].tobytes() + bytes(4)
+
+
+if __name__ == "__main__":
+
+    # minimal decoders, after the reference ones
+    def unzigzag(v: int) -> int:
+        return (v >> 1) ^ -(v & 1)
+
+    def decodeVertexBuffer(data: bytes, count: int, stride: int) -> numpy.ndarray:
+        assert(data[0] == VERTEX_HEADER)
+        blockSize = min(BLOCK_MAX_SIZE, (BLOCK_SIZE_BYTES // stride) & ~(GROUP_SIZE - 1))
+        last = list(data[-stride:])
+        result = numpy.zeros((count, stride), dtype=numpy.uint8)
+        i = 1
+        for start in range(0, count, blockSize):
+            size = min(blockSize, count - start)
+            groups = -(-size // GROUP_SIZE)
+            for k in range(stride):
+                header = data[i:i + -(-groups // 4)]
+                i += len(header)
+                deltas = []
+                for group in range(groups):
+                    mode = (header[group // 4] >> (group % 4 * 2)) & 3
+                    if mode == 0:
+                        deltas += [0] * GROUP_SIZE
+                    elif mode == 3:
+                        deltas += list(data[i:i + GROUP_SIZE])
+                        i += GROUP_SIZE
+                    else:
+                        bits = 2 if mode == 1 else 4
+                        packed = data[i:i + bits * 2]
+                        i += bits * 2
+                        for value in [(byte >> shift) & ((1 << bits) - 1) for byte in packed for shift in range(8 - bits, -1, -bits)]:
+                            if value == (1 << bits) - 1:
+                                value = data[i]
+                                i += 1
+                            deltas.append(value)
+                for n in range(size):
+                    last[k] = (last[k] + unzigzag(deltas[n])) & 0xff
+                    result[start + n, k] = last[k]
+        assert(i == len(data) - max(TAIL_MAX_SIZE, stride))
+        return result
+
+    def decodeIndexSequence(data: bytes, count: int) -> numpy.ndarray:
+        assert(data[0] == SEQUENCE_HEADER)
+        last = [0, 0]
+        result = []
+        i = 1
+        for _ in range(count):
+            v = shift = 0
+            while True:
+                v |= (data[i] & 127) << shift
+                shift += 7
+                i += 1
+                if data[i - 1] < 128:
+                    break
+            baseline = v & 1
+            last[baseline] = (last[baseline] + unzigzag(v >> 1)) & 0xffffffff
+            result.append(last[baseline])
+        assert(i == len(data) - 4)
+        return numpy.array(result, dtype=numpy.uint32)
+
+    rnd = numpy.random.default_rng(0)
+    # noise (raw groups), smooth data (2 and 4 bits groups with escapes), zeros, over several blocks
+    smooth = numpy.cumsum(rnd.integers(-3, 4, (600, 12)), axis=0).astype(numpy.uint8)
+    for vertices in [rnd.integers(0, 256, (300, 8), dtype=numpy.uint8), smooth, numpy.zeros((17, 4), dtype=numpy.uint8),
+                     numpy.zeros((0, 16), dtype=numpy.uint8)]:
+        encoded = encodeVertexBuffer(vertices)
+        assert((decodeVertexBuffer(encoded, *vertices.shape) == vertices).all())
+
+    triangles = numpy.arange(3000) // 2 + rnd.integers(0, 40, 3000)
+    for indices in [triangles, numpy.array([0, 1 << 29, 7, 0xffffffff, 3]), numpy.array([], dtype=numpy.uint32)]:
+        assert((decodeIndexSequence(encodeIndexSequence(indices), len(indices)) == indices).all())
+    # pinned: zigzagged deltas 0, 1, -1, 64 as varints (low bit: baseline 0)
+    assert(encodeIndexSequence(numpy.array([0, 1, 0, 64])) == bytes([SEQUENCE_HEADER, 0, 4, 2, 0x80, 2, 0, 0, 0, 0]))
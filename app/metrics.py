@@ -0,0 +1,137 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, List
+
+# Process wide timers and counters, always on (a timer costs about a microsecond):
+#
+#   timers    stage -> calls and seconds, summed over the threads (so overlapping stages can add up
+#             to more than the wall time); the worker processes stages are not seen, the time
+#             waiting for them is
+#   counters  name -> value
+#   sources   name -> function returning a dict of values (e.g. TileCache.stats), read on export
+#
+# exported as a JSON summary or as a Prometheus textfile (node_exporter textfile collector)
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers: Dict[str, List[float]] = {}
+        self.counters: Dict[str, float] = {}
+        self.sources: Dict[str, Callable[[], dict]] = {}
+        self.started = time.time()
+
+    def observe(self, name: str, seconds: float, calls: int = 1):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+
+    def count(self, name: str, n: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def source(self, name: str, stats: Callable[[], dict]):
+        self.sources[name] = stats
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    # decorator timing each call of a function
+    def timed(self, name: str):
+        def decorator(function):
+            @wraps(function)
+            def timedFunction(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start)
+            return timedFunction
+        return decorator
+
+    def summary(self) -> dict:
+        with self._lock:
+            timers = {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in sorted(self.timers.items())}
+            counters = dict(sorted(self.counters.items()))
+        return {
+            'elapsed': time.time() - self.started,
+            'timers': timers,
+            'counters': counters,
+            'sources': {name: stats() for name, stats in sorted(self.sources.items())},
+        }
+
+    def prometheus(self, prefix: str = "getmaptiles") -> str:
+        summary = self.summary()
+        lines = [
+            f"# TYPE {prefix}_elapsed_seconds gauge",
+            f"{prefix}_elapsed_seconds {summary['elapsed']}",
+            f"# TYPE {prefix}_stage_calls_total counter",
+        ]
+        lines += [f'{prefix}_stage_calls_total{{stage="{name}"}} {timer["calls"]}' for name, timer in summary['timers'].items()]
+        lines.append(f"# TYPE {prefix}_stage_seconds_total counter")
+        lines += [f'{prefix}_stage_seconds_total{{stage="{name}"}} {timer["seconds"]}' for name, timer in summary['timers'].items()]
+        values = list(summary['counters'].items())
+        values += [(f"{source}_{name}", value) for source, stats in summary['sources'].items() for name, value in stats.items()]
+        for name, value in values:
+            if isinstance(value, (int, float)):
+                name = f"{prefix}_{_snakeCase(name)}"
+                lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def writeJson(self, path: str):
+        if path == "-":
+            print(json.dumps(self.summary(), indent=1))
+            return
+        _writeFile(path, json.dumps(self.summary(), indent=1))
+
+    def writePrometheus(self, path: str):
+        _writeFile(path, self.prometheus())
+
+
+# cacheHits.bytes -> cache_hits_bytes
+def _snakeCase(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", re.sub(r"(?<=[a-z0-9])([A-Z])", r"_\1", name)).lower()
+
+
+# the collector may read it at any time, so it is renamed into place
+def _writeFile(path: str, content: str):
+    tmp = f"{path}.tmp-{os.getpid()}"
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+metrics = Metrics()
+
+
+if __name__ == "__main__":
+    m = Metrics()
+    with m.timer("download"):
+        pass
+    m.observe("download", 0.5)
+    m.count("glbBytes", 100)
+    m.source("cache", lambda: {'hits': 3, 'bytesRead': 10})
+
+    @m.timed("decode")
+    def decode(x):
+        return x * 2
+    assert(decode(2) == 4)
+
+    summary = m.summary()
+    assert(summary['timers']['download']['calls'] == 2 and summary['timers']['download']['seconds'] >= 0.5)
+    assert(summary['timers']['decode']['calls'] == 1 and summary['counters'] == {'glbBytes': 100})
+    text = m.prometheus()
+    assert('getmaptiles_stage_calls_total{stage="download"} 2' in text)
+    assert('getmaptiles_glb_bytes 100' in text and 'getmaptiles_cache_bytes_read 10' in text)
@@ -0,0 +1,227 @@
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import BinaryIO, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from app.cesium import read3dm, getUrl
+from app.download import Downloader
+from app.geo import getTiles
+from app.gltf import ENCODINGS, Job, Jobs, ReadData, concatenate, readGltf
+from app.metrics import metrics
+from app.tile import Tile
+
+# Tile service: merges areas on demand, in a long running process sharing between the requests
+#   - the downloader (its connections pool) and the pyproj transformers
+#   - the last `capacity` tiles, downloaded and decoded (LRU), a tile wanted by concurrent requests
+#     being loaded once
+#
+#   GET /convert?bbox=LNG0,LAT0,LNG1,LAT1&level=17[&encoding=float]   the GLB, streamed (no Content-Length)
+#   GET /stats                                                         tiles LRU and metrics, JSON
+#
+# Tiles stay in memory until evicted, a refresh of the cache doesn't reach them. A tile failing to
+# load fails the requests merging it (500), missing tiles (not found, not downloaded) are skipped.
+
+Entry = Tuple[Job, ReadData]
+
+
+class TileService:
+
+    def __init__(self, downloader: Downloader, decoded=None, capacity: int = 2048, requests: int = 4, readahead: int = 8):
+        self.downloader = downloader
+        # a DecodedTileCache behind the LRU, if any
+        self.decoded = decoded
+        self.capacity = capacity
+        self.readahead = readahead
+        self._tiles: 'OrderedDict[str, Entry]' = OrderedDict()
+        self._loading: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        # concurrent merges
+        self._requests = threading.Semaphore(requests)
+
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def _load(self, tile: Tile) -> Optional[Entry]:
+        data = self.downloader.fetch(getUrl(tile))
+        if data is None:
+            return None
+        try:
+            gltf, feature = read3dm(data)
+            job = Job(tile.name, gltf, feature['RTC_CENTER'])
+            input = None if self.decoded is None else self.decoded.get(job.key, job.blob)
+            if input is None:
+                input = readGltf(job.blob)
+                if self.decoded is not None:
+                    self.decoded.put(job.key, job.blob, input)
+        except Exception as e:
+            raise Exception(f"{tile} not loaded: {e}") from e
+        return job, input
+
+    # the tile from the LRU, from the loading started by another request, or loaded now
+    def entry(self, tile: Tile) -> Optional[Entry]:
+        with self._lock:
+            entry = self._tiles.get(tile.name)
+            if entry is not None:
+                self._tiles.move_to_end(tile.name)
+                self.hits += 1
+                return entry
+            future = self._loading.get(tile.name)
+            loading = future is None
+            if loading:
+                self.misses += 1
+                future = self._loading[tile.name] = Future()
+            else:
+                self.shared += 1
+        if not loading:
+            return future.result()
+
+        try:
+            entry = self._load(tile)
+        except BaseException as e:
+            # the requests sharing the loading fail as well
+            with self._lock:
+                del self._loading[tile.name]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._loading[tile.name]
+            # missing tiles are asked for again next time
+            if entry is not None:
+                self._tiles[tile.name] = entry
+                while len(self._tiles) > self.capacity:
+                    self._tiles.popitem(last=False)
+                    self.evictions += 1
+        future.set_result(entry)
+        return entry
+
+    # concatenate's decoded tiles cache: the tiles decoded when loaded
+    def get(self, key: str, source: bytes) -> Optional[ReadData]:
+        with self._lock:
+            entry = self._tiles.get(key)
+        # evicted during the merge, or reloaded since
+        if entry is None or entry[0].blob is not source:
+            return None
+        return entry[1]
+
+    def put(self, key: str, source: bytes, data: ReadData):
+        pass
+
+    # out of memory, e.g. no more needed
+    def forget(self, tile: Tile):
+        with self._lock:
+            self._tiles.pop(tile.name, None)
+
+    # the tiles jobs, loaded ahead, to be merged with this service as cache
+    def jobs(self, tiles: List[Tile]) -> Jobs:
+        def provider(tile: Tile) -> Optional[Job]:
+            entry = self.entry(tile)
+            return None if entry is None else entry[0]
+
+        return Jobs(tiles, provider, self.readahead)
+
+    # merge the tiles (getTiles) into output
+    def convert(self, tiles: List[Tile], output: BinaryIO, encoding: str = "float"):
+        with self._requests, metrics.timer("request"):
+            concatenate(self.jobs(tiles), output, 0, self, encoding=encoding)
+
+    def stats(self):
+        with self._lock:
+            tiles = len(self._tiles)
+        return {
+            'tiles': tiles,
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'shared': self.shared,
+            'evictions': self.evictions,
+        }
+
+
+# The GLB is only written once all its tiles are merged: the 200 goes out with its first bytes, a
+# failure before is still answered with an error.
+class Response:
+
+    def __init__(self, handler: BaseHTTPRequestHandler):
+        self.handler = handler
+        self.started = False
+
+    def write(self, data) -> int:
+        if not self.started:
+            self.started = True
+            # streamed as it is written, the connection end marks the end of the GLB
+            self.handler.send_response(200)
+            self.handler.send_header("Content-Type", "model/gltf-binary")
+            self.handler.send_header("Connection", "close")
+            self.handler.end_headers()
+        return self.handler.wfile.write(data)
+
+
+class Handler(BaseHTTPRequestHandler):
+    service: TileService = None
+
+    def _error(self, status: int, message: str):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.end_headers()
+        self.wfile.write(message.encode("utf-8"))
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if url.path == "/stats":
+            body = json.dumps({'tiles': self.service.stats(), 'metrics': metrics.summary()}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if url.path != "/convert":
+            self._error(404, "not found")
+            return
+
+        try:
+            bbox = [float(value) for value in query["bbox"].split(",")]
+            level = int(query.get("level", 17))
+            encoding = query.get("encoding", "float")
+            if len(bbox) != 4 or not 12 <= level <= 21 or encoding not in ENCODINGS:
+                raise ValueError()
+            # no tiles: corners swapped
+            tiles = getTiles(level - 1, *bbox)
+            if not tiles:
+                raise ValueError()
+        except (KeyError, ValueError):
+            self._error(400, f"usage: /convert?bbox=LNG0,LAT0,LNG1,LAT1&level=12..21&encoding={'|'.join(ENCODINGS)}")
+            return
+
+        response = Response(self)
+        try:
+            self.service.convert(tiles, response, encoding)
+        except Exception as e:
+            print(f"failed! {e}")
+            if response.started:
+                # too late for an error, the GLB is left truncated
+                self.close_connection = True
+                return
+            self._error(500, f"merge failed: {e}")
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} {format % args}")
+
+
+def serve(service: TileService, host: str = "127.0.0.1", port: int = 8000):
+    handler = type("ServiceHandler", (Handler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    print(f"serving on http://{host}:{server.server_address[1]}/convert?bbox=LNG0,LAT0,LNG1,LAT1&level=17")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
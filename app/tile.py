@@ -1,4 +1,5 @@
 import math
+from typing import List, NamedTuple, Optional
 
 # Tile organization:
 #
@@ -102,22 +103,112 @@ class BasicTileSystem(TileSystem):
 
     def tile2Pos(self, name):
         assert(len(name) == self.level)
-        x, y = TileSystem.tile2Pos(self, name)
-        raw = [(x - 1) / 2, -(y + 1) / 2]
-        x = int(raw[0])
-        assert(x == raw[0])
-        y = int(raw[1])
-        assert(y == raw[1])
-        return [x, y]
+        tile = Tile.fromName(name)
+        return [tile.x, tile.y]
 
     def pos2Tile(self, xy):
         x, y = xy
-        x = x * 2 + 1
-        y = -y * 2 - 1
-        return TileSystem.pos2Tile(self, self.level, [x, y])
+        return Tile.fromPos(self.level, x, y).name
+
+    # batch pos2Tile, for arrays of tiles coordinates
+    def pos2Tiles(self, xs, ys):
+        import numpy
+        codes = morton(numpy.asarray(xs, dtype=numpy.uint64), numpy.asarray(ys, dtype=numpy.uint64), self.level)
+        return mortonNames(codes, self.level)
+
+
+# spread the 32 lower bits of v on the even bits
+def _spread(v):
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+# gather the even bits of v, the inverse of _spread
+def _compact(v):
+    v = v & 0x5555555555555555
+    v = (v | (v >> 1)) & 0x3333333333333333
+    v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+    v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+    v = (v | (v >> 16)) & 0x00000000FFFFFFFF
+    return v
+
+
+# interleave the bits of tiles coordinates, the code digits in base 4 are the tile name:
+# x is the high bit of each digit (right: 2 or 3), y, flipped, the low one (bottom: 0 or 2)
+def morton(xs, ys, level):
+    mask = (1 << level) - 1
+    return (_spread(xs) << 1) | _spread(~ys & mask)
+
+
+def mortonNames(codes, level):
+    import numpy
+    if level == 0:
+        return [''] * len(codes)
+    shifts = numpy.arange(2 * (level - 1), -1, -2, dtype=numpy.uint64)
+    digits = ((codes[:, None] >> shifts) & 3).astype(numpy.uint8) + ord('0')
+    return digits.view(f"S{level}").ravel().astype(str).tolist()
+
+
+# each hex digit is 2 name digits
+_HEX_NAMES = {f"{i:x}": f"{i >> 2}{i & 3}" for i in range(16)}
+
+
+# A tile as its level (the name length) and its morton code (the name in base 4).
+# Cheap to hash, sort (by level, then in name order) and store in arrays,
+# the name string is only built when needed, for urls.
+class Tile(NamedTuple):
+    level: int
+    code: int
+
+    @staticmethod
+    def fromName(name: str) -> "Tile":
+        return Tile(len(name), int(name, 4) if name else 0)
+
+    @staticmethod
+    def fromPos(level: int, x: int, y: int) -> "Tile":
+        return Tile(level, morton(x, y, level))
+
+    @property
+    def name(self) -> str:
+        if self.level == 0:
+            return ''
+        hex = format(self.code, f"0{(self.level + 1) // 2}x")
+        return ''.join(_HEX_NAMES[c] for c in hex)[-self.level:]
+
+    def __str__(self) -> str:
+        return self.name
+
+    @property
+    def x(self) -> int:
+        return _compact(self.code >> 1)
+
+    @property
+    def y(self) -> int:
+        return ~_compact(self.code) & ((1 << self.level) - 1)
+
+    def parent(self) -> "Tile":
+        assert(self.level > 0)
+        return Tile(self.level - 1, self.code >> 2)
+
+    def children(self) -> List["Tile"]:
+        return [Tile(self.level + 1, (self.code << 2) | digit) for digit in range(4)]
+
+    # None when out of the tile system
+    def neighbour(self, dx: int, dy: int) -> Optional["Tile"]:
+        x = self.x + dx
+        y = self.y + dy
+        if not (0 <= x < (1 << self.level) and 0 <= y < (1 << self.level)):
+            return None
+        return Tile.fromPos(self.level, x, y)
 
 
 if __name__ == "__main__":
+    import numpy
 
     ts = TileSystem(100, 100)
 
@@ -172,3 +263,21 @@ if __name__ == "__main__":
     assert(ts3.pos2Tile([0, 0]) == "111")
     assert(ts3.pos2Tile([7, 7]) == "222")
     assert(ts3.pos2Tile([5, 4]) == "213")
+    assert(ts3.pos2Tiles([0, 7, 5], [0, 7, 4]) == ["111", "222", "213"])
+
+    ts13 = BasicTileSystem(13)
+    xs, ys = numpy.meshgrid(numpy.arange(4090, 4110), numpy.arange(3000, 3020))
+    assert(ts13.pos2Tiles(xs.ravel(), ys.ravel()) == [ts13.pos2Tile([x, y]) for x, y in zip(xs.ravel(), ys.ravel())])
+
+    tile = Tile.fromName("213")
+    assert(tile == Tile(3, 0b100111))
+    assert(tile.name == "213" and str(tile) == "213")
+    assert([tile.x, tile.y] == [5, 4])
+    assert(Tile.fromPos(3, 5, 4) == tile)
+    assert(tile.parent() == Tile.fromName("21"))
+    assert([child.name for child in tile.children()] == ["2130", "2131", "2132", "2133"])
+    assert(tile.neighbour(1, 0).name == "231")
+    assert(tile.neighbour(0, -1).name == "302")
+    assert(tile.neighbour(3, 0) is None)
+    assert(Tile.fromName("").name == "" and Tile.fromName("1111111111111").name == "1111111111111")
+    assert(sorted([Tile.fromName("3"), Tile.fromName("10"), Tile.fromName("02")]) == [Tile.fromName("3"), Tile.fromName("02"), Tile.fromName("10")])
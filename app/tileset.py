@@ -0,0 +1,120 @@
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+
+from app.cesium import read3dm, getUrl
+from app.download import Downloader
+from app.geo import ts
+from app.gltf import readGltf
+from app.tile import Tile
+
+# 3D Tiles tileset: the tiles of an area and their ancestors, down to `minLevel`, laid out as the
+# source quadtree. Each node content is the source b3dm (it already has its RTC_CENTER), copied under
+# the same path as on the server, so the tileset can be streamed by a viewer from {directory}/tileset.json
+#
+# https://github.com/CesiumGS/3d-tiles/tree/main/specification
+
+# a node error is this ratio of its edge (refined under 16 px at ~ 1.5 edge on a full HD screen), leaves have none
+GEOMETRIC_ERROR_RATIO = 1 / 16
+
+Sphere = Tuple[numpy.ndarray, float]
+
+
+def tileEdge(tile: Tile) -> float:
+    return ts.ROOT_TILE[2] / 2 ** tile.level
+
+
+# bounding sphere of a b3dm content in ECEF, from its RTC_CENTER and positions bounds
+def contentSphere(data: bytes) -> Sphere:
+    gltf, feature = read3dm(data)
+    points = readGltf(gltf).points
+    if points.accessor.min is not None and points.accessor.max is not None:
+        low, high = numpy.array(points.accessor.min), numpy.array(points.accessor.max)
+    else:
+        array = numpy.frombuffer(points.blob, dtype="<f4").reshape(-1, 3)
+        low, high = array.min(axis=0), array.max(axis=0)
+    # glTF y-up to 3D Tiles z-up
+    center = (low + high) / 2
+    center = numpy.array([center[0], -center[2], center[1]])
+    return numpy.array(feature.get('RTC_CENTER', [0, 0, 0])) + center, float(numpy.linalg.norm(high - low) / 2)
+
+
+# sphere around spheres (not the smallest one)
+def encloseSpheres(spheres: List[Sphere]) -> Sphere:
+    center = numpy.mean([c for c, _ in spheres], axis=0)
+    return center, max(float(numpy.linalg.norm(c - center)) + r for c, r in spheres)
+
+
+def _nodeSphere(node: dict) -> Sphere:
+    sphere = node['boundingVolume']['sphere']
+    return numpy.array(sphere[:3]), sphere[3]
+
+
+def writeTileset(downloader: Downloader, tiles: List[Tile], minLevel: int, directory: str):
+    # the tiles and their ancestors, by level
+    levels: List[List[Tile]] = [sorted(set(tiles))]
+    while levels[0][0].level > minLevel:
+        levels.insert(0, sorted({tile.parent() for tile in levels[0]}))
+    nodes = [tile for level in levels for tile in level]
+    tree = set(nodes)
+
+    spheres: Dict[Tile, Sphere] = {}
+    for idx, (tile, data) in enumerate(zip(nodes, downloader.map(getUrl(tile) for tile in nodes))):
+        print(f"{idx + 1}/{len(nodes)}: {tile}")
+        if data is None:
+            continue
+        try:
+            spheres[tile] = contentSphere(data)
+        except Exception:
+            print(f"failed! {tile}")
+            continue
+        path = os.path.join(directory, getUrl(tile)[1:])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    leafLevel = levels[-1][0].level
+
+    # an ancestor content covers more than the area, only the area is refined
+    def node(tile: Tile) -> Optional[dict]:
+        children = [child for child in map(node, [t for t in tile.children() if t in tree]) if child is not None]
+        if tile not in spheres and not children:
+            return None
+
+        sphere = encloseSpheres(([spheres[tile]] if tile in spheres else []) + [_nodeSphere(child) for child in children])
+        result = {
+            'boundingVolume': {'sphere': sphere[0].tolist() + [sphere[1]]},
+            'geometricError': 0 if tile.level == leafLevel else tileEdge(tile) * GEOMETRIC_ERROR_RATIO,
+            'refine': 'REPLACE',
+        }
+        if tile in spheres:
+            result['content'] = {'uri': getUrl(tile)[1:]}
+        if children:
+            result['children'] = children
+        return result
+
+    roots = [root for root in map(node, levels[0]) if root is not None]
+    if not roots:
+        raise Exception("no tile found")
+    if len(roots) == 1:
+        root = roots[0]
+    else:
+        # the area spans several minLevel tiles
+        sphere = encloseSpheres([_nodeSphere(root) for root in roots])
+        root = {
+            'boundingVolume': {'sphere': sphere[0].tolist() + [sphere[1]]},
+            'geometricError': tileEdge(levels[0][0].parent()) * GEOMETRIC_ERROR_RATIO,
+            'refine': 'REPLACE',
+            'children': roots,
+        }
+
+    tileset = {
+        'asset': {'version': '1.0'},
+        'geometricError': tileEdge(levels[0][0]),
+        'root': root,
+    }
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "tileset.json"), "w") as f:
+        json.dump(tileset, f, indent=1)
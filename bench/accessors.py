@@ -0,0 +1,54 @@
+import struct
+import sys
+import timeit
+
+import numpy
+from pygltflib import Accessor, BufferView
+
+from app.gltf import _getAccessorDataFormat, _readAccessorArray
+
+# python -m bench.accessors [count]
+# compares the vectorized accessor decoding with the former per-element loop
+
+
+# the readBlobAccessor loop, as it was before the numpy views
+def _loopReadAccessor(accessor: Accessor, bufferView: BufferView, data: bytes) -> numpy.ndarray:
+    [size, format, unitaryFormat] = _getAccessorDataFormat(accessor)
+    list = []
+    for i in range(accessor.count):
+        index = bufferView.byteOffset + accessor.byteOffset + i * size
+        d = data[index:index + size]
+        v = struct.unpack(format, d)
+        list.append(v)
+    return numpy.array(list, dtype=unitaryFormat)
+
+
+def _accessors(count: int):
+    rnd = numpy.random.default_rng(0)
+    arrays = [
+        ('POSITION', rnd.random((count, 3), dtype=numpy.float32), 5126, 'VEC3'),
+        ('TEXCOORD_0', rnd.random((count, 2), dtype=numpy.float32), 5126, 'VEC2'),
+        ('indices', rnd.integers(0, count, (count * 2, 1), dtype=numpy.uint16), 5123, 'SCALAR'),
+    ]
+    for name, array, componentType, type in arrays:
+        data = array.tobytes()
+        accessor = Accessor(bufferView=0, byteOffset=0, componentType=componentType, count=len(array), type=type)
+        bufferView = BufferView(buffer=0, byteOffset=0, byteLength=len(data))
+        yield name, accessor, bufferView, data
+
+
+def run(count: int = 10000, repeat: int = 5):
+    print(f"{'accessor':<12}{'count':>8}{'loop ms':>10}{'numpy ms':>10}{'speedup':>10}")
+    for name, accessor, bufferView, data in _accessors(count):
+        loop = _loopReadAccessor(accessor, bufferView, data)
+        vectorized = _readAccessorArray(accessor, bufferView, data)
+        assert loop.tobytes() == vectorized.tobytes()
+
+        number = 3
+        t0 = min(timeit.repeat(lambda: _loopReadAccessor(accessor, bufferView, data).tobytes(), number=number, repeat=repeat)) / number
+        t1 = min(timeit.repeat(lambda: _readAccessorArray(accessor, bufferView, data).tobytes(), number=number, repeat=repeat)) / number
+        print(f"{name:<12}{accessor.count:>8}{t0 * 1000:>10.3f}{t1 * 1000:>10.3f}{t0 / t1:>9.0f}x")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
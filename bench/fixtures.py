@@ -0,0 +1,164 @@
+import json
+import os
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy
+from pygltflib import (
+    GLTF2, Accessor, Attributes, Buffer, BufferView, Image, Material, Mesh, Node, PbrMetallicRoughness,
+    Primitive, Sampler, Scene, Texture, TextureInfo, ARRAY_BUFFER, ELEMENT_ARRAY_BUFFER
+)
+
+from app.cesium import getUrl
+from app.geo import getTilesBBoxes, getTilesNames, llh2xyz, xy2ll
+
+# synthetic tiles, laid out as the photogrammetry ones: a single mesh, primitive, texture and sampler
+# `grid` x `grid` vertices, and `textureSize` bytes standing for the JPEG texture
+
+
+# interleaved: texture coordinates and positions in a single bufferView (byteStride 20), the
+# positions accessor starting at byteOffset 8
+def makeGlb(seed: int, grid: int = 64, textureSize: int = 30000, interleaved: bool = False) -> bytes:
+    rnd = numpy.random.default_rng(seed)
+    xs, zs = numpy.meshgrid(numpy.linspace(-50, 50, grid), numpy.linspace(-50, 50, grid))
+    points = numpy.stack([xs.ravel(), rnd.random(grid * grid) * 5, zs.ravel()], axis=-1).astype("<f4")
+    textCoord0 = numpy.stack([(xs.ravel() + 50) / 100, (zs.ravel() + 50) / 100], axis=-1).astype("<f4")
+    quads = (numpy.arange(grid - 1)[None, :] + grid * numpy.arange(grid - 1)[:, None]).ravel()
+    indices = numpy.stack([quads, quads + 1, quads + grid, quads + 1, quads + grid + 1, quads + grid], axis=-1)
+    indices = indices.astype("<u2" if grid * grid < 65536 else "<u4").ravel()
+    # JPEG markers around random (incompressible) bytes
+    texture = b'\xff\xd8\xff\xe0' + rnd.integers(0, 256, textureSize - 6, dtype=numpy.uint8).tobytes() + b'\xff\xd9'
+
+    gltf = GLTF2()
+    data = bytearray()
+    if interleaved:
+        views = [(numpy.concatenate([textCoord0, points], axis=-1), ARRAY_BUFFER, 20), (indices, ELEMENT_ARRAY_BUFFER, None), (texture, None, None)]
+    else:
+        views = [(points, ARRAY_BUFFER, None), (textCoord0, ARRAY_BUFFER, None), (indices, ELEMENT_ARRAY_BUFFER, None), (texture, None, None)]
+    for blob, target, byteStride in views:
+        blob = bytes(blob)
+        gltf.bufferViews.append(BufferView(buffer=0, byteOffset=len(data), byteLength=len(blob), byteStride=byteStride, target=target))
+        data += blob
+        data += bytes(-len(data) % 4)
+    # bufferView and byteOffset of the points, texture coordinates, indices, then the texture bufferView
+    layout = [(0, 8), (0, 0), (1, 0), 2] if interleaved else [(0, 0), (1, 0), (2, 0), 3]
+    gltf.buffers = [Buffer(byteLength=len(data))]
+    gltf.accessors = [
+        Accessor(bufferView=layout[0][0], byteOffset=layout[0][1], componentType=5126, count=len(points), type="VEC3",
+                 max=points.max(axis=0).tolist(), min=points.min(axis=0).tolist()),
+        Accessor(bufferView=layout[1][0], byteOffset=layout[1][1], componentType=5126, count=len(textCoord0), type="VEC2"),
+        Accessor(bufferView=layout[2][0], byteOffset=layout[2][1], componentType=5123 if indices.dtype.itemsize == 2 else 5125,
+                 count=len(indices), type="SCALAR"),
+    ]
+    gltf.images = [Image(bufferView=layout[3], mimeType="image/jpeg")]
+    gltf.samplers = [Sampler(magFilter=9729, minFilter=9987, wrapS=33071, wrapT=33071)]
+    gltf.textures = [Texture(sampler=0, source=0)]
+    gltf.materials = [Material(pbrMetallicRoughness=PbrMetallicRoughness(baseColorTexture=TextureInfo(index=0)))]
+    gltf.meshes = [Mesh(primitives=[Primitive(attributes=Attributes(POSITION=0, TEXCOORD_0=1), indices=2, material=0)])]
+    gltf.nodes = [Node(mesh=0)]
+    gltf.scenes = [Scene(nodes=[0])]
+    gltf.scene = 0
+    gltf.set_binary_blob(bytes(data))
+    return b''.join(gltf.save_to_bytes())
+
+
+def makeB3dm(seed: int, center, grid: int = 64, textureSize: int = 30000) -> bytes:
+    glb = makeGlb(seed, grid, textureSize)
+    feature = json.dumps({"BATCH_LENGTH": 0, "RTC_CENTER": list(center)}).encode("utf-8")
+    feature += b' ' * (-(28 + len(feature)) % 8)
+    length = 28 + len(feature) + len(glb)
+    return b'b3dm' + struct.pack('<6I', 1, length, len(feature), 0, 0, 0) + feature + glb
+
+
+# top left tile of the README area, in getTilesNames levels (cli level - 1)
+AREA_LEVEL = 16
+AREA_ORIGIN = (142, 135)
+
+
+# bbox [lngLeft, latTop, lngRight, latBottom] of exactly `columns` x `rows` tiles from AREA_ORIGIN
+def area(columns: int, rows: int, level: int = AREA_LEVEL):
+    x, y = AREA_ORIGIN
+    left, top, _, _ = getTilesBBoxes(level, x, y).tolist()
+    _, _, right, bottom = getTilesBBoxes(level, x + columns - 1, y + rows - 1).tolist()
+    # 1 m inside, the corners must not fall on the next tiles
+    lats, lngs = xy2ll(numpy.array([left + 1, right - 1]), numpy.array([top - 1, bottom + 1]))
+    return [lngs.tolist()[0], lats.tolist()[0], lngs.tolist()[1], lats.tolist()[1]]
+
+
+# the area tiles as b3dm under `directory`, at their getUrl paths, centered on their tile
+def writeTiles(directory: str, bbox, level: int = AREA_LEVEL, grid: int = 64, textureSize: int = 30000) -> int:
+    tiles = getTilesNames(level, *bbox, True)
+    rectangles = numpy.array([tile['data'] for tile in tiles])
+    xs, ys, zs = llh2xyz((rectangles[:, 1] + rectangles[:, 3]) / 2, (rectangles[:, 0] + rectangles[:, 2]) / 2, numpy.full(len(tiles), 30.0))
+    size = 0
+    for idx, (tile, center) in enumerate(zip(tiles, zip(xs.tolist(), ys.tolist(), zs.tolist()))):
+        path = os.path.join(directory, getUrl(tile['name'])[1:])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = makeB3dm(idx, center, grid, textureSize)
+        with open(path, "wb") as f:
+            f.write(data)
+        size += len(data)
+    return size
+
+
+# local tile server over `directory`: each request waits `latency` seconds, then fails (503)
+# with an `errorRate` probability, missing tiles are 404
+class StubServer:
+
+    def __init__(self, directory: str, latency: float = 0, errorRate: float = 0, seed: int = 0):
+        self.directory = directory
+        self.latency = latency
+        self.errorRate = errorRate
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(stub.latency)
+                with stub._lock:
+                    stub.requests += 1
+                    failed = stub._random.random() < stub.errorRate
+                    stub.errors += failed
+                if failed:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                try:
+                    with open(os.path.join(stub.directory, self.path.lstrip("/")), "rb") as f:
+                        data = f.read()
+                except OSError:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    @property
+    def root(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from app.cache import TileCache
+from app.cesium import getUrl, read3dm
+from app.download import Downloader
+from app.geo import getTilesNames
+from app.gltf import Job, Jobs, concatenateFile, readGltf
+from app.metrics import metrics
+from bench.fixtures import AREA_LEVEL, StubServer, area, writeTiles
+
+# python -m bench.pipeline [--tiles 20 660 2552] [--latency S] [--error-rate P] [--parallelism N] [--workers N]
+# the convert stages over synthetic tiles served by a local stub, one process per area size:
+#   names        getTilesNames
+#   fetch        downloads into an empty cache (retries included)
+#   read3dm      b3dm to glTF, tiles read from the cache
+#   readGltf     glTF decoding, tiles read from the cache
+#   concatenate  the merge streamed to a file, as convert does (tiles read from the cache, read3dm and
+#                readGltf included), but for its end
+#   write        that end: the GLB header, then the spilled BIN copied to the file
+# with the peak RSS of the process so far after each stage
+
+# tiles count -> area columns, rows
+SIZES = {20: (5, 4), 660: (30, 22), 2552: (58, 44)}
+
+
+def _peakRss():
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure(tiles: int, root: str, directory: str, parallelism: int = 8, workers: int = 0):
+    bbox = area(*SIZES[tiles])
+    stages = []
+
+    def stage(name, start, size):
+        stages.append({'stage': name, 'seconds': time.perf_counter() - start, 'bytes': size, 'peakRss': _peakRss()})
+
+    start = time.perf_counter()
+    names = getTilesNames(AREA_LEVEL, *bbox)
+    stage("names", start, 0)
+    urls = [getUrl(name) for name in names]
+
+    cache = TileCache(os.path.join(directory, "cache"))
+    downloader = Downloader(root, cache, parallelism, backoff=0.01, maxBackoff=0.1)
+    start = time.perf_counter()
+    size = sum(len(data) for data in downloader.map(urls) if data is not None)
+    stage("fetch", start, size)
+
+    read3dmTime = readGltfTime = 0
+    b3dmSize = gltfSize = 0
+    for url in urls:
+        data = cache.get(url)
+        t0 = time.perf_counter()
+        gltf, _ = read3dm(data)
+        t1 = time.perf_counter()
+        readGltf(gltf)
+        read3dmTime += t1 - t0
+        readGltfTime += time.perf_counter() - t1
+        b3dmSize += len(data)
+        gltfSize += len(gltf)
+    stages.append({'stage': "read3dm", 'seconds': read3dmTime, 'bytes': b3dmSize, 'peakRss': _peakRss()})
+    stages.append({'stage': "readGltf", 'seconds': readGltfTime, 'bytes': gltfSize, 'peakRss': _peakRss()})
+
+    def provider(url: str) -> Job:
+        gltf, feature = read3dm(cache.get(url))
+        return Job(url, gltf, feature['RTC_CENTER'])
+
+    def serialized() -> float:
+        return metrics.summary()['timers'].get('serialize', {}).get('seconds', 0)
+
+    path = os.path.join(directory, "merge.glb")
+    start = time.perf_counter()
+    before = serialized()
+    concatenateFile(Jobs(urls, provider, parallelism), path, workers)
+    seconds = time.perf_counter() - start
+    write = serialized() - before
+    size = os.path.getsize(path)
+    stages.append({'stage': "concatenate", 'seconds': seconds - write, 'bytes': size, 'peakRss': _peakRss()})
+    stages.append({'stage': "write", 'seconds': write, 'bytes': size, 'peakRss': _peakRss()})
+
+    return {
+        'tiles': len(names),
+        'downloaded': downloader.downloaded,
+        'retries': downloader.retried,
+        'failures': downloader.failures,
+        'stages': stages,
+    }
+
+
+def run(sizes=(20, 660, 2552), latency: float = 0.02, errorRate: float = 0.01, parallelism: int = 8, workers: int = 0):
+    print(f"latency {latency * 1000:.0f} ms, error rate {errorRate:.1%}, parallelism {parallelism}, workers {workers}")
+    for tiles in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            served = os.path.join(directory, "tiles")
+            size = writeTiles(served, area(*SIZES[tiles]))
+            with StubServer(served, latency, errorRate) as server:
+                result = subprocess.run([sys.executable, "-m", "bench.pipeline", "--measure", str(tiles), server.root, directory,
+                                         "--parallelism", str(parallelism), "--workers", str(workers)],
+                                        capture_output=True, text=True, check=True)
+            result = json.loads(result.stdout.splitlines()[-1])
+
+        print(f"\n{result['tiles']} tiles ({size / 1e6:.1f} MB), {result['retries']} retries, {result['failures']} failures")
+        print(f"{'stage':<12}{'s':>9}{'tiles/s':>10}{'MB/s':>9}{'peak RSS MB':>13}")
+        for stage in result['stages']:
+            seconds = max(stage['seconds'], 1e-9)
+            peak = "n/a" if stage['peakRss'] is None else f"{stage['peakRss'] / 1e6:.0f}"
+            print(f"{stage['stage']:<12}{stage['seconds']:>9.3f}{result['tiles'] / seconds:>10.0f}"
+                  f"{stage['bytes'] / seconds / 1e6:>9.1f}{peak:>13}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m bench.pipeline")
+    parser.add_argument("--tiles", type=int, nargs="+", choices=sorted(SIZES), default=sorted(SIZES))
+    parser.add_argument("--latency", type=float, default=0.02, help="stub server latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="stub server 503 probability")
+    parser.add_argument("--parallelism", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=0)
+    # a single size, in the process measured
+    parser.add_argument("--measure", nargs=3, metavar=("TILES", "ROOT", "DIRECTORY"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure is not None:
+        tiles, root, directory = args.measure
+        result = measure(int(tiles), root, directory, args.parallelism, args.workers)
+        print(json.dumps(result))
+    else:
+        run(args.tiles, args.latency, args.error_rate, args.parallelism, args.workers)
@@ -0,0 +1,77 @@
+import sys
+import timeit
+import tracemalloc
+
+from pygltflib import GLTF2
+
+from app.gltf import BlobAccessor, BlobImage, Job, Jobs, ReadData, _readAccessorArray, concatenate, readGltf
+from bench.fixtures import makeGlb
+
+# python -m bench.readgltf [grid]
+# compares readGltf with the former pygltflib read path, time and allocations per tile
+
+
+# readGltf, as it was with pygltflib
+def _pygltflibReadGltf(data: bytes) -> ReadData:
+    gltf = GLTF2().load_from_bytes(data)
+
+    def readBlobAccessor(accessorIndex: int) -> BlobAccessor:
+        accessor = gltf.accessors[accessorIndex]
+        bufferView = gltf.bufferViews[accessor.bufferView]
+        buffer = gltf.buffers[bufferView.buffer]
+        data = gltf.get_data_from_buffer_uri(buffer.uri)
+        return BlobAccessor(_readAccessorArray(accessor, bufferView, data).tobytes(), accessor)
+
+    def readBlobImage(imageIndex: int) -> BlobImage:
+        image = gltf.images[imageIndex]
+        bufferView = gltf.bufferViews[image.bufferView]
+        buffer = gltf.buffers[bufferView.buffer]
+        data = gltf.get_data_from_buffer_uri(buffer.uri)
+        return BlobImage(data[bufferView.byteOffset:bufferView.byteOffset + bufferView.byteLength], image)
+
+    mesh = gltf.meshes[gltf.scenes[gltf.scene].nodes[0]]
+    primitive = mesh.primitives[0]
+    return ReadData(
+        readBlobAccessor(primitive.attributes.POSITION),
+        readBlobAccessor(primitive.attributes.TEXCOORD_0),
+        readBlobAccessor(primitive.indices),
+        readBlobImage(0),
+        gltf.samplers[0])
+
+
+def _allocated(read, data: bytes) -> int:
+    tracemalloc.start()
+    input = read(data)
+    size = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del input
+    return size
+
+
+def run(grid: int = 64, repeat: int = 5):
+    data = makeGlb(0, grid)
+    reference = _pygltflibReadGltf(data)
+    input = readGltf(data)
+    for old, new in [(reference.points, input.points), (reference.textCoord0, input.textCoord0),
+                     (reference.indices, input.indices), (reference.texture, input.texture)]:
+        assert bytes(old.blob) == bytes(new.blob)
+    assert reference.points.accessor == input.points.accessor and reference.sampler == input.sampler
+
+    # interleaved accessors (byteStride, byteOffset) come packed, and merge as the others
+    interleavedData = makeGlb(0, grid, interleaved=True)
+    interleaved = readGltf(interleavedData)
+    for packed, strided in [(input.points, interleaved.points), (input.textCoord0, interleaved.textCoord0), (input.indices, interleaved.indices)]:
+        assert bytes(packed.blob) == bytes(strided.blob) and strided.accessor.byteOffset == 0
+    merged = [b''.join(concatenate(Jobs([glb], lambda glb: Job("0", glb, [0, 0, 0])))) for glb in [data, interleavedData]]
+    assert merged[0] == merged[1]
+
+    number = 20
+    print(f"tile: {len(data)} bytes, {grid * grid} vertices")
+    print(f"{'read path':<12}{'ms/tile':>10}{'KiB allocated':>16}")
+    for name, read in [("pygltflib", _pygltflibReadGltf), ("readGltf", readGltf)]:
+        t = min(timeit.repeat(lambda: read(data), number=number, repeat=repeat)) / number
+        print(f"{name:<12}{t * 1000:>10.3f}{_allocated(read, data) / 1024:>16.1f}")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 64)
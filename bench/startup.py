@@ -0,0 +1,37 @@
+import subprocess
+import sys
+
+# python -m bench.startup
+# `python -X importtime` of the cli: app.cli must import within its budget,
+# and without any of the heavy dependencies, which are only imported by the commands using them
+
+BUDGET_US = 50000
+HEAVY = ["numpy", "pyproj", "pygltflib", "requests"]
+
+
+def importTimes(module: str):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def run(repeat: int = 5):
+    runs = [importTimes("app.cli") for _ in range(repeat)]
+    best = min(times["app.cli"] for times in runs)
+    heavy = [name for name in HEAVY if name in runs[0]]
+    print(f"app.cli: {best / 1000:.1f} ms (budget {BUDGET_US / 1000:.0f} ms)")
+    for name in ["dotenv", "app.geo", "app.tile", "app.cesium"]:
+        print(f"  {name}: {min(times[name] for times in runs) / 1000:.1f} ms")
+    if heavy:
+        print(f"heavy dependencies imported: {', '.join(heavy)}")
+    return best <= BUDGET_US and not heavy
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run() else 1)